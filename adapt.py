@@ -1,39 +1,130 @@
 from collections.abc import Callable
 import traceback
+import uuid
+import weakref
 from typing import Dict, Sequence
 from langchain_core.callbacks import CallbackManagerForLLMRun
 from langchain_core.embeddings import Embeddings
 from langchain_core.messages import AIMessage
 from langchain_core.messages.base import BaseMessage
-from langchain_core.outputs import ChatResult
+from langchain_core.outputs import ChatGeneration, ChatResult
 from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import ensure_config, get_config_list
 from langchain_core.language_models import LanguageModelLike, BaseChatModel
 import asyncio
 import httpx
 from langchain_core.tools import BaseTool
+from pydantic_ai.embeddings import EmbeddingResult
+from pydantic_ai.embeddings.settings import merge_embedding_settings
+from pydantic_ai.embeddings.wrapper import WrapperEmbeddingModel
+from bgloop import run_sync
 from config import *
+from embcache import EmbeddingCache
+from health import Attempt, HealthBoard
 
 logger = get_log(__name__)
 
 
+def model_name(index: int, model: LanguageModelLike) -> str:
+    name = getattr(model, "model_name", None) or getattr(model, "model", None)
+    return f"{index}:{name or type(model).__name__}"
+
+
 class ChatMux(BaseChatModel):
-    def __init__(self, models: list[LanguageModelLike]):
+    def __init__(
+        self,
+        models: list[LanguageModelLike],
+        names: list[str] | None = None,
+        board: HealthBoard | None = None,
+        max_concurrency: int = 8,
+    ):
         self._models = models
+        self._names = names or [model_name(i, m) for i, m in enumerate(models)]
+        self._board = board or HealthBoard()
+        self._max_concurrency = max_concurrency
 
     def bind_tools(self, tools, *, tool_choice=None, **kwargs):
         return ChatMux(
-            [m.bind_tools(tools, tool_choice=tool_choice) for m in self._models]  # type: ignore
+            [m.bind_tools(tools, tool_choice=tool_choice) for m in self._models],  # type: ignore
+            self._names,
+            self._board,
+            self._max_concurrency,
         )
 
+    # Sync entry points race on the background loop, calling each model's own
+    # sync `invoke` in a worker thread: the models' async clients may already be
+    # bound to the caller's loop. Losing threads finish in the background.
+
     def invoke(self, input, config=None, *, stop=None, **kwargs) -> AIMessage:
-        raise NotImplementedError
+        return run_sync(self._race(input, config, True, stop=stop, **kwargs))
+
+    def batch(self, inputs, config=None, *, return_exceptions=False, **kwargs):
+        return run_sync(self._batch(inputs, config, return_exceptions, True, **kwargs))
+
+    async def abatch(self, inputs, config=None, *, return_exceptions=False, **kwargs):
+        return await self._batch(inputs, config, return_exceptions, False, **kwargs)
+
+    async def _batch(
+        self, inputs, config, return_exceptions: bool, blocking: bool, **kwargs
+    ):
+        """Race each input like `ainvoke`, at most `max_concurrency` at a time."""
+        if not inputs:
+            return []
+        configs = get_config_list(config, len(inputs))
+        sem = asyncio.Semaphore(
+            configs[0].get("max_concurrency") or self._max_concurrency
+        )
+
+        async def one(input, config):
+            async with sem:
+                try:
+                    return await self._race(input, config, blocking, **kwargs)
+                except Exception as e:
+                    if return_exceptions:
+                        return e
+                    raise
+
+        return await asyncio.gather(*(one(i, c) for i, c in zip(inputs, configs)))
+
+    def _claim(self, ranked: list[int], kind: str = "") -> dict[int, Attempt]:
+        """
+        Attempts on the ranked models, leaving out half-open ones being probed.
+        Raises if that leaves none, as no model can take the call right now.
+        """
+        attempts = {i: self._board[self._names[i]].claim(kind) for i in ranked}
+        claimed = {i: a for i, a in attempts.items() if a is not None}
+        if not claimed:
+            raise RuntimeError(
+                f"all {len(self._models)} llm circuits are half-open with a probe in flight"
+            )
+        return claimed
+
+    async def _ainvoke_one(
+        self, index: int, attempt: Attempt, input, config, blocking: bool, **kwargs
+    ):
+        model = self._models[index]
+        with attempt:
+            if blocking:
+                ret = await asyncio.to_thread(model.invoke, input, config, **kwargs)
+            else:
+                ret = await model.ainvoke(input, config, **kwargs)
+            attempt.success()
+        return ret
 
     async def ainvoke(self, input, config=None, **kwargs) -> AIMessage:
+        return await self._race(input, config, False, **kwargs)
+
+    async def _race(self, input, config, blocking: bool, **kwargs) -> AIMessage:
+        ranked = self._board.rank(
+            list(range(len(self._models))), lambda i: self._names[i]
+        )
         pending = [
-            asyncio.create_task(m.ainvoke(input, config, **kwargs))
-            for m in self._models
+            asyncio.create_task(
+                self._ainvoke_one(i, attempt, input, config, blocking, **kwargs)
+            )
+            for i, attempt in self._claim(ranked).items()
         ]
-        logger.info(f"requesting {len(self._models)} llms")
+        logger.info(f"requesting {len(pending)}/{len(self._models)} llms")
         result = None
         exc = []
         while True:
@@ -61,7 +152,99 @@ class ChatMux(BaseChatModel):
             raise ExceptionGroup(f"all {len(self._models)} llm invokes failed", exc)
 
     def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
-        raise NotImplementedError
+        message = run_sync(self._race(messages, None, True, stop=stop, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    @staticmethod
+    def _has_output(chunk) -> bool:
+        return bool(
+            chunk.content
+            or getattr(chunk, "tool_call_chunks", None)
+            or chunk.additional_kwargs.get("reasoning_content")
+        )
+
+    async def _first_chunks(self, index: int, attempt: Attempt, stream) -> list:
+        """Read `stream` up to and including its first chunk with real output."""
+        buffered = []
+        with attempt:
+            async for chunk in stream:
+                buffered.append(chunk)
+                if self._has_output(chunk):
+                    attempt.success()
+                    return buffered
+            raise ValueError(f"{self._names[index]} stream ended without output")
+
+    async def astream(self, input, config=None, **kwargs):
+        """
+        Race the models on their first content or tool call chunk, cancel the
+        others, then stream the winner's chunks as they arrive.
+        """
+        ranked = self._board.rank(
+            list(range(len(self._models))), lambda i: self._names[i], "stream"
+        )
+        attempts = self._claim(ranked, "stream")
+        streams = {
+            i: self._models[i].astream(input, config, **kwargs) for i in attempts
+        }
+        pending = {
+            asyncio.create_task(self._first_chunks(i, attempts[i], stream)): i
+            for i, stream in streams.items()
+        }
+        logger.info(f"streaming {len(pending)}/{len(self._models)} llms")
+        winner = None
+        buffered = []
+        exc = []
+        try:
+            while pending and winner is None:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for d in done:
+                    index = pending.pop(d)
+                    if e := d.exception():
+                        exc.append(e)
+                    elif winner is None:
+                        winner = index
+                        buffered = d.result()
+        finally:
+            for p in pending:
+                p.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            for i, stream in streams.items():
+                if i != winner:
+                    await stream.aclose()
+        if winner is None:
+            raise ExceptionGroup(f"all {len(self._models)} llm streams failed", exc)
+        logger.info(f"streaming from {self._names[winner]}")
+        stream = streams[winner]
+        try:
+            for chunk in buffered:
+                yield chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    async def astream_events(self, input, config=None, *, version="v2", **kwargs):
+        """
+        `on_chat_model_start`, `_stream` and `_end` events for the racing
+        stream of `astream`, with the mux as the only run.
+        """
+        config = ensure_config(config)
+        event = {
+            "name": config.get("run_name") or self.get_name(),
+            "run_id": str(config.get("run_id") or uuid.uuid4()),
+            "tags": config.get("tags") or [],
+            "metadata": config.get("metadata") or {},
+            "parent_ids": [],
+        }
+        yield {**event, "event": "on_chat_model_start", "data": {"input": input}}
+        output = None
+        async for chunk in self.astream(input, config, **kwargs):
+            output = chunk if output is None else output + chunk
+            yield {**event, "event": "on_chat_model_stream", "data": {"chunk": chunk}}
+        yield {**event, "event": "on_chat_model_end", "data": {"output": output}}
 
     @property
     def _llm_type(self) -> str:
@@ -70,81 +253,120 @@ class ChatMux(BaseChatModel):
 
 class GiteeAIEmbeddings(Embeddings):
     def __init__(
-        self, model: str, base_url: str, api_key: str, dimensions: int
+        self,
+        model: str,
+        base_url: str,
+        api_key: str,
+        dimensions: int,
+        batch_size: int = 32,
+        concurrency: int = 4,
+        cache: EmbeddingCache | None = None,
     ) -> None:
-        from lru import LRU
-
         super().__init__()
         self.model = model
         self.base_url = base_url
         self.api_key = api_key
         self.dimensions = dimensions
-        self.lru = LRU(120)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.cache = cache or EmbeddingCache(":memory:", 4096)
+        self._clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, asyncio.Semaphore]
+        ] = weakref.WeakKeyDictionary()
 
     def embed_documents(self, texts: list[str]) -> list[list[float]]:
-        return asyncio.run(self.aembed_documents(texts))
+        return run_sync(self.aembed_documents(texts))
 
     def embed_query(self, text: str) -> list[float]:
-        return asyncio.run(self.aembed_query(text))
+        return run_sync(self.aembed_query(text))
 
     async def aembed_query(self, text: str) -> list[float]:
         return (await self.aembed_documents([text]))[0]
 
-    # def _s_request(self, client: httpx.Client, t: str) -> list[float]:
-    #     if res := self.lru.get(t):
-    #         return res
-    #     for retry in range(3):
-    #         try:
-    #             resp = client.post(
-    #                 "https://ai.gitee.com/v1/embeddings",
-    #                 timeout=30,
-    #                 headers={
-    #                     "Content-Type": "application/json",
-    #                     "Authorization": "Bearer " + self.api_key,
-    #                 },
-    #                 json={
-    #                     "model": self.model,
-    #                     "input": t,
-    #                     "encoding_format": "float",
-    #                     "dimensions": self.dimensions,
-    #                 },
-    #             )
-    #             res = resp.json()["data"][0]["embedding"]
-    #             self.lru[t] = res
-    #             return res
-    #         except Exception as e:
-    #             logger.error(f"embedder error: {traceback.format_exc()}")
-    #             time.sleep(retry * 5 + 5)
-    #     raise Exception("embedder: too many retries")
-
-    async def _request(self, client: httpx.AsyncClient, t: str) -> list[float]:
-        if res := self.lru.get(t):
-            return res
+    def _get_client(self) -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        # the client and semaphore belong to the loop they were created in;
+        # sync calls all share the background loop's pair
+        loop = asyncio.get_running_loop()
+        if (pair := self._clients.get(loop)) is None:
+            client = httpx.AsyncClient(
+                base_url=self.base_url.rstrip("/") + "/",
+                headers={"Authorization": "Bearer " + self.api_key},
+                timeout=30,
+            )
+            pair = self._clients[loop] = client, asyncio.Semaphore(self.concurrency)
+        return pair
+
+    async def _request(
+        self, client: httpx.AsyncClient, texts: list[str]
+    ) -> list[list[float]]:
         for retry in range(3):
             try:
                 resp = await client.post(
-                    "https://ai.gitee.com/v1/embeddings",
-                    timeout=30,
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": "Bearer " + self.api_key,
-                    },
+                    "embeddings",
                     json={
                         "model": self.model,
-                        "input": t,
+                        "input": texts,
                         "encoding_format": "float",
                         "dimensions": self.dimensions,
                     },
                 )
-                res = resp.json()["data"][0]["embedding"]
-                self.lru[t] = res
-                return res
+                data = sorted(resp.json()["data"], key=lambda d: d["index"])
+                if len(data) != len(texts):
+                    raise ValueError(f"got {len(data)} embeddings for {len(texts)}")
+                return [d["embedding"] for d in data]
             except Exception:
                 logger.error(f"embedder error: {traceback.format_exc()}")
                 await asyncio.sleep(retry * 5 + 5)
         raise Exception("embedder: too many retries")
 
+    async def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        client, sem = self._get_client()
+        async with sem:
+            return await self._request(client, texts)
+
     async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
-        async with httpx.AsyncClient() as client:
-            ret = await asyncio.gather(*(self._request(client, t) for t in texts))
-        return ret
+        found = await self.cache.aget(self.model, self.dimensions, texts)
+        missing = list(dict.fromkeys(t for t in texts if t not in found))
+        batches = [
+            missing[i : i + self.batch_size]
+            for i in range(0, len(missing), self.batch_size)
+        ]
+        results = await asyncio.gather(*(self._embed_batch(b) for b in batches))
+        fresh = {t: res for b, vs in zip(batches, results) for t, res in zip(b, vs)}
+        await self.cache.aput(self.model, self.dimensions, fresh)
+        found.update(fresh)
+        return [found[t] for t in texts]
+
+
+class CachedEmbeddingModel(WrapperEmbeddingModel):
+    """pydantic-ai embedding model that serves repeated texts from an `EmbeddingCache`."""
+
+    def __init__(self, wrapped, cache: EmbeddingCache) -> None:
+        super().__init__(wrapped)
+        self.cache = cache
+
+    async def embed(self, inputs, *, input_type, settings=None) -> EmbeddingResult:
+        texts, _ = self.prepare_embed(inputs, settings)
+        # the wrapped model's own settings, as it will apply them, so the key
+        # matches GiteeAIEmbeddings' for the same model and dimensions
+        merged = merge_embedding_settings(self.wrapped.settings, settings) or {}
+        dimensions = merged.get("dimensions")
+        found = await self.cache.aget(self.model_name, dimensions, texts)
+        missing = list(dict.fromkeys(t for t in texts if t not in found))
+        usage = None
+        if missing:
+            result = await self.wrapped.embed(
+                missing, input_type=input_type, settings=settings
+            )
+            fresh = {t: list(v) for t, v in zip(missing, result.embeddings)}
+            await self.cache.aput(self.model_name, dimensions, fresh)
+            found.update(fresh)
+            usage = result.usage
+        return EmbeddingResult(
+            [found[t] for t in texts],
+            inputs=texts,
+            input_type=input_type,
+            model_name=self.model_name,
+            provider_name=self.system,
+            **({"usage": usage} if usage is not None else {}),
+        )
@@ -2,19 +2,22 @@ from dataclasses import dataclass
 from oicq.mcp import get_instructions
 from time import time
 from pydantic import BaseModel
-from agenting.summarization import summarize
+from agenting.summarization import over_budget, summarize
 from config import *
 from oicq.events import wait_events
 from oicq.status import get_status
 from utils import get_date
 from .types import BotDeps, BotState
-from .prompts import initial_prompts
+from .memqueue import memory_queue
+from .prompts import initial_prompts, note_prompts
+from .tools import run_tools
 from components import chat_model
 from pydantic_graph import BaseNode, Graph
 from pydantic_ai.direct import model_request
 from pydantic_ai.models import ModelRequestParameters
 from pydantic_ai import (
     ModelRequest,
+    ModelResponse,
     RunContext,
     RunUsage,
     ToolReturnPart,
@@ -26,6 +29,16 @@ logger = get_log(__name__)
 BotNode = BaseNode[BotState, BotDeps, None]
 
 
+def log_usage(resp: ModelResponse):
+    usage = resp.usage
+    if usage.input_tokens:
+        ratio = usage.cache_read_tokens / usage.input_tokens
+        logger.info(
+            f"prompt tokens: {usage.input_tokens}, cached: {usage.cache_read_tokens}"
+            f" ({ratio:.0%}), output tokens: {usage.output_tokens}"
+        )
+
+
 @dataclass
 class Idle(BotNode):
     until: float | None = None
@@ -75,6 +88,13 @@ class IdleCall(BaseModel):
     minutes: int
 
 
+IDLE_TOOL = ToolDefinition(
+    name="idle",
+    description=IdleCall.__doc__,
+    parameters_json_schema=IdleCall.model_json_schema(),
+)
+
+
 @dataclass
 class Action(BotNode):
     info_inject: str | None = None
@@ -83,17 +103,11 @@ class Action(BotNode):
         msgs = ctx.state.messages
         tool_ctx = RunContext(deps=ctx.deps, model=chat_model, usage=RunUsage())
         toolset = ctx.deps.toolset
-        tool_defs = [t.tool_def for t in (await toolset.get_tools(tool_ctx)).values()]
-        tool_defs.append(
-            ToolDefinition(
-                name="idle",
-                description=IdleCall.__doc__,
-                parameters_json_schema=IdleCall.model_json_schema(),
-            )
-        )
+        tools, tool_defs = await ctx.deps.catalogue.get(tool_ctx)
+        tool_defs = tool_defs + [IDLE_TOOL]
         if self.info_inject:
             msgs.append(ModelRequest.user_text_prompt(self.info_inject))
-        msgs_send = initial_prompts(ctx.deps, ctx.state) + msgs
+        msgs_send = initial_prompts(ctx.deps, ctx.state) + msgs + note_prompts()
         resp = await model_request(
             chat_model,
             msgs_send,
@@ -101,51 +115,52 @@ class Action(BotNode):
                 function_tools=tool_defs, output_mode="tool"
             ),
         )
+        log_usage(resp)
         msgs.append(resp)
         ctx.state.messages = msgs
         tool_ctx.messages = msgs
         now = time()
-        for call in resp.tool_calls:
-            if call.tool_name == "idle":
-                idle_call = IdleCall.model_validate(call.args_as_dict())
-                idle_minutes = idle_call.minutes
-
-                ctx.state.messages.append(
-                    ModelRequest(
-                        [
-                            ToolReturnPart(
-                                tool_name=call.tool_name,
-                                tool_call_id=call.tool_call_id,
-                                content=f"Idle {idle_call.minutes} minutes...",
-                            )
-                        ]
-                    )
+        calls = resp.tool_calls
+        # calls after an idle are never run
+        idle = next((i for i, c in enumerate(calls) if c.tool_name == "idle"), None)
+        run = calls if idle is None else calls[:idle]
+        for call, tool_res in zip(run, await run_tools(toolset, tools, run, tool_ctx)):
+            ctx.state.messages.append(
+                ModelRequest(
+                    [
+                        ToolReturnPart(
+                            tool_name=call.tool_name,
+                            tool_call_id=call.tool_call_id,
+                            content=tool_res,
+                        )
+                    ]
                 )
+            )
+        if idle is not None:
+            call = calls[idle]
+            idle_call = IdleCall.model_validate(call.args_as_dict())
+            idle_minutes = idle_call.minutes
+
+            ctx.state.messages.append(
+                ModelRequest(
+                    [
+                        ToolReturnPart(
+                            tool_name=call.tool_name,
+                            tool_call_id=call.tool_call_id,
+                            content=f"Idle {idle_call.minutes} minutes...",
+                        )
+                    ]
+                )
+            )
 
-                tire_level = ctx.state.tire_level
-                if not idle_minutes:
-                    tire_level += 1
-                else:
-                    tire_level /= max(1.2, idle_minutes / 2)
-                ctx.state.tire_level = tire_level
-
-                return ContextNg(now + 60 * idle_minutes, tool_defs)
+            tire_level = ctx.state.tire_level
+            if not idle_minutes:
+                tire_level += 1
             else:
-                tools = await toolset.get_tools(tool_ctx)
-                tool_res = await toolset.call_tool(
-                    call.tool_name, call.args_as_dict(), tool_ctx, tools[call.tool_name]
-                )
-                ctx.state.messages.append(
-                    ModelRequest(
-                        [
-                            ToolReturnPart(
-                                tool_name=call.tool_name,
-                                tool_call_id=call.tool_call_id,
-                                content=tool_res,
-                            )
-                        ]
-                    )
-                )
+                tire_level /= max(1.2, idle_minutes / 2)
+            ctx.state.tire_level = tire_level
+
+            return ContextNg(now + 60 * idle_minutes, tool_defs)
         return Idle(None)
 
 
@@ -156,8 +171,15 @@ class ContextNg(BotNode):
 
     async def run(self, ctx) -> Idle:
         msgs_send = initial_prompts(ctx.deps, ctx.state) + ctx.state.messages
+        if not over_budget(self.tool_defs, msgs_send):
+            return Idle(self.idle_until)
+        logger.info("context over budget, summarizing")
         sum, upd = await summarize(chat_model, self.tool_defs, msgs_send)
         if sum and upd:
+            # hand the dropped window to the memory workers, without waiting for them
+            await memory_queue.put(
+                ctx.state.messages[: len(ctx.state.messages) - len(upd)]
+            )
             ctx.state.messages = upd
             ctx.state.summary = sum
         return Idle(self.idle_until)
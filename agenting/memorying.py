@@ -1,5 +1,9 @@
 import asyncio
+import os
 import traceback
+import unicodedata
+from collections.abc import Sequence
+import numpy as np
 from langchain_core.messages import (
     AnyMessage,
     AIMessage,
@@ -7,13 +11,17 @@ from langchain_core.messages import (
     SystemMessage,
 )
 from langgraph.func import task, entrypoint
+from langchain_core.documents import Document
 from langchain_core.language_models import LanguageModelLike
-from components import make_chroma, llm, llm2
+from components import make_chroma, llm
 from config import *
 import json
-from mem0.memory.utils import remove_code_blocks, extract_json
-from mem0.configs.prompts import get_update_memory_messages
+import re
+from langchain_core.utils.json import parse_partial_json
+from metrics import Counter, Registry
+from time import time
 from utils import get_date
+from vecstore import amax_marginal_relevance_search_many, backfill_metadata
 
 logger = get_log(__name__)
 
@@ -41,21 +49,23 @@ MEMORY_EXTRACTION_PROMPT = """
 
 以下是一些少量示例：
 
-约翰：你好，我在旧金山找一家餐厅。
+[group 20002 ("美食群")]
+约翰 10001：你好，我在旧金山找一家餐厅。
 助手：好的，我能帮忙。您有什么特别想吃的菜系吗？
-输出：{{"facts": ["约翰想在旧金山找一家餐厅"]}}
+输出：{{"facts": [{{"text": "约翰想在旧金山找一家餐厅", "users": ["10001"], "chat": "group:20002"}}]}}
 
-约翰：昨天下午3点我和亚历克斯开了个会，我们讨论了新项目。
+约翰 10001：昨天下午3点我和亚历克斯 10003 开了个会，我们讨论了新项目。
 助手：听起来是个高效的会议。
-输出：{{"facts": ["昨天下午3点约翰和亚历克斯开会讨论了新项目"]}}
+输出：{{"facts": [{{"text": "昨天下午3点约翰和亚历克斯开会讨论了新项目", "users": ["10001", "10003"]}}]}}
 
+[private 10001 ("约翰")]
 约翰：你好，我叫约翰，是一名软件工程师。
 助手：很高兴认识你，约翰！有什么可以帮你的？
-输出：{{"facts": ["约翰是软件工程师"]}}
+输出：{{"facts": [{{"text": "约翰是软件工程师", "users": ["10001"], "chat": "private:10001"}}]}}
 
-亚历克斯：我最喜欢的电影是《盗梦空间》和《星际穿越》。
+亚历克斯 10003：我最喜欢的电影是《盗梦空间》和《星际穿越》。
 助手：好选择！这两部都是很棒的电影。
-输出：{{"facts": ["亚历克斯最喜欢的电影是《黑暗骑士》和《肖申克的救赎》"]}}
+输出：{{"facts": [{{"text": "亚历克斯最喜欢的电影是《黑暗骑士》和《肖申克的救赎》", "users": ["10003"]}}]}}
 
 请按照以上示例的JSON格式返回事实和偏好。
 
@@ -63,7 +73,8 @@ MEMORY_EXTRACTION_PROMPT = """
 - 当前时间是{date}。
 - 不要返回上方提供的自定义少量示例提示中的任何内容。
 - 如果没有提取到任何事实，返回与"facts"键对应的空列表。
-- 请确保按照示例中提到的格式返回响应。响应应为JSON格式，键为"facts"，对应的值为字符串列表。
+- 请确保按照示例中提到的格式返回响应。响应应为JSON格式，键为"facts"，对应的值为事实对象列表。
+- 事实对象的"text"为事实内容；"users"为事实涉及人物的QQ号列表；"chat"为事实来源的会话，群聊为"group:群号"，私聊为"private:QQ号"。无法确定的字段省略。
 - 使用最能保持信息原样的语言记录事实。
 
 现在，请开始执行此任务。直接按照上述JSON格式返回。
@@ -76,58 +87,618 @@ MEMORY_QUERY_PROMPT = """
 """
 
 
-async def llm_xjson(model: LanguageModelLike, msg):
+# REF: mem0.configs.prompts.DEFAULT_UPDATE_MEMORY_PROMPT
+MEMORY_UPDATE_PROMPT = """You are a smart memory manager which controls the memory of a system.
+You can perform four operations: (1) add into the memory, (2) update the memory, (3) delete from the memory, and (4) no change.
+
+Based on the above four operations, the memory will change.
+
+Compare newly retrieved facts with the existing memory. For each new fact, decide whether to:
+- ADD: Add it to the memory as a new element
+- UPDATE: Update an existing memory element
+- DELETE: Delete an existing memory element
+- NONE: Make no change (if the fact is already present or irrelevant)
+
+There are specific guidelines to select which operation to perform:
+
+1. **Add**: If the retrieved facts contain new information not present in the memory, then you have to add it by generating a new ID in the id field.
+- **Example**:
+    - Old Memory:
+        [
+            {
+                "id" : "0",
+                "text" : "User is a software engineer"
+            }
+        ]
+    - Retrieved facts: ["Name is John"]
+    - New Memory:
+        {
+            "memory" : [
+                {
+                    "id" : "0",
+                    "text" : "User is a software engineer",
+                    "event" : "NONE"
+                },
+                {
+                    "id" : "1",
+                    "text" : "Name is John",
+                    "event" : "ADD"
+                }
+            ]
+
+        }
+
+2. **Update**: If the retrieved facts contain information that is already present in the memory but the information is totally different, then you have to update it.
+If the retrieved fact contains information that conveys the same thing as the elements present in the memory, then you have to keep the fact which has the most information.
+Example (a) -- if the memory contains "User likes to play cricket" and the retrieved fact is "Loves to play cricket with friends", then update the memory with the retrieved facts.
+Example (b) -- if the memory contains "Likes cheese pizza" and the retrieved fact is "Loves cheese pizza", then you do not need to update it because they convey the same information.
+If the direction is to update the memory, then you have to update it.
+Please keep in mind while updating you have to keep the same ID.
+Please note to return the IDs in the output from the input IDs only and do not generate any new ID.
+- **Example**:
+    - Old Memory:
+        [
+            {
+                "id" : "0",
+                "text" : "I really like cheese pizza"
+            },
+            {
+                "id" : "1",
+                "text" : "User is a software engineer"
+            },
+            {
+                "id" : "2",
+                "text" : "User likes to play cricket"
+            }
+        ]
+    - Retrieved facts: ["Loves chicken pizza", "Loves to play cricket with friends"]
+    - New Memory:
+        {
+        "memory" : [
+                {
+                    "id" : "0",
+                    "text" : "Loves cheese and chicken pizza",
+                    "event" : "UPDATE",
+                    "old_memory" : "I really like cheese pizza"
+                },
+                {
+                    "id" : "1",
+                    "text" : "User is a software engineer",
+                    "event" : "NONE"
+                },
+                {
+                    "id" : "2",
+                    "text" : "Loves to play cricket with friends",
+                    "event" : "UPDATE",
+                    "old_memory" : "User likes to play cricket"
+                }
+            ]
+        }
+
+
+3. **Delete**: If the retrieved facts contain information that contradicts the information present in the memory, then you have to delete it. Or if the direction is to delete the memory, then you have to delete it.
+Please note to return the IDs in the output from the input IDs only and do not generate any new ID.
+- **Example**:
+    - Old Memory:
+        [
+            {
+                "id" : "0",
+                "text" : "Name is John"
+            },
+            {
+                "id" : "1",
+                "text" : "Loves cheese pizza"
+            }
+        ]
+    - Retrieved facts: ["Dislikes cheese pizza"]
+    - New Memory:
+        {
+        "memory" : [
+                {
+                    "id" : "0",
+                    "text" : "Name is John",
+                    "event" : "NONE"
+                },
+                {
+                    "id" : "1",
+                    "text" : "Loves cheese pizza",
+                    "event" : "DELETE"
+                }
+        ]
+        }
+
+4. **No Change**: If the retrieved facts contain information that is already present in the memory, then you do not need to make any changes.
+- **Example**:
+    - Old Memory:
+        [
+            {
+                "id" : "0",
+                "text" : "Name is John"
+            },
+            {
+                "id" : "1",
+                "text" : "Loves cheese pizza"
+            }
+        ]
+    - Retrieved facts: ["Name is John"]
+    - New Memory:
+        {
+        "memory" : [
+                {
+                    "id" : "0",
+                    "text" : "Name is John",
+                    "event" : "NONE"
+                },
+                {
+                    "id" : "1",
+                    "text" : "Loves cheese pizza",
+                    "event" : "NONE"
+                }
+            ]
+        }
+"""
+
+
+def update_memory_messages(memories: list[dict], facts: list[str]) -> str:
+    """
+    The memory update prompt for `facts` against the retrieved `memories`.
+    REF: mem0.configs.prompts.get_update_memory_messages
+    """
+    if memories:
+        current = f"""Below is the current content of my memory which I have collected till now. You have to update it in the following format only:
+
+```
+{memories}
+```"""
+    else:
+        current = "Current memory is empty."
+    return f"""{MEMORY_UPDATE_PROMPT}
+{current}
+
+The new retrieved facts are mentioned in the triple backticks. You have to analyze the new retrieved facts and determine whether these facts should be added, updated, or deleted in the memory.
+
+```
+{facts}
+```
+
+You must return your response in the following JSON structure only:
+
+{{
+    "memory" : [
+        {{
+            "id" : "<ID of the memory>",                # Use existing ID for updates/deletes, or new ID for additions
+            "text" : "<Content of the memory>",         # Content of the memory
+            "event" : "<Operation to be performed>",    # Must be "ADD", "UPDATE", "DELETE", or "NONE"
+            "old_memory" : "<Old memory content>",      # Required only if the event is "UPDATE"
+            "facts" : [<index of a new fact>, ...]      # Required only if the event is "ADD" or "UPDATE"
+        }},
+        ...
+    ]
+}}
+
+Follow the instruction mentioned below:
+- Do not return anything from the custom few shot prompts provided above.
+- If the current memory is empty, then you have to add the new retrieved facts to the memory.
+- You should return the updated memory in only JSON format as shown below. The memory key should be the same if no changes are made.
+- If there is an addition, generate a new key and add the new memory corresponding to it.
+- If there is a deletion, the memory key-value pair should be removed from the memory.
+- If there is an update, the ID key should remain the same and only the value needs to be updated.
+- For an addition or an update, list in "facts" the indexes of the new retrieved facts the memory is written from.
+
+Do not return anything except the JSON format.
+"""
+
+
+FACTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "facts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "text": {"type": "string"},
+                    "users": {"type": "array", "items": {"type": "string"}},
+                    "chat": {"type": "string"},
+                },
+                "required": ["text"],
+            },
+        }
+    },
+    "required": ["facts"],
+}
+
+MEMORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "memory": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "text": {"type": "string"},
+                    "event": {"enum": ["ADD", "UPDATE", "DELETE", "NONE"]},
+                    "old_memory": {"type": "string"},
+                    "facts": {"type": "array", "items": {"type": "integer"}},
+                },
+                "required": ["id", "text", "event"],
+            },
+        }
+    },
+    "required": ["memory"],
+}
+
+# response formats to try, most constrained first; a model that rejects one
+# is asked for the next until FORMAT_RETRY seconds pass, then tried again
+FORMATS = ["json_schema", "json_object", "text"]
+FORMAT_RETRY = 3600
+formats: dict[int, tuple[int, float]] = {}
+
+registry = Registry()
+xjson_calls = registry.add(
+    Counter("memory_llm_json_calls_total", "LLM calls for JSON output by format.")
+)
+xjson_retries = registry.add(
+    Counter("memory_llm_json_retries_total", "Repeated LLM JSON calls by reason.")
+)
+xjson_repaired = registry.add(
+    Counter("memory_llm_json_repaired_total", "JSON outputs parsed only after repair.")
+)
+METRICS_FILE = DATADIR + "/memory.prom"
+
+
+def export_metrics():
+    """
+    Log the counters and write them to METRICS_FILE, in the text format
+    node_exporter's textfile collector reads.
+    """
+    samples = [s for m in registry.metrics for s in m.samples()]
+    logger.info(
+        "memory llm json counters: "
+        + ", ".join(
+            f"{name}{{{','.join(f'{k}={v}' for k, v in labels)}}}={value:g}"
+            for name, labels, value in samples
+        )
+    )
+    try:
+        with open(METRICS_FILE + ".tmp", "w") as f:
+            f.write(registry.render())
+        os.replace(METRICS_FILE + ".tmp", METRICS_FILE)
+    except OSError as e:
+        logger.warning(f"writing {METRICS_FILE} failed: {e}")
+
+
+CODE_BLOCK = re.compile(r"^```[a-zA-Z0-9]*\n([\s\S]*?)\n```$")
+THINK = re.compile(r"<think>.*?</think>", re.DOTALL)
+
+
+def parse_json(text: str) -> dict | None:
+    """
+    The JSON object in `text`, tolerating code fences, reasoning, surrounding
+    prose, trailing commas and output cut off part way through.
+    """
+    text = THINK.sub("", CODE_BLOCK.sub(r"\1", text.strip()))
+    start = text.find("{")
+    if start < 0:
+        return None
+    text = text[start:]
+    try:
+        result = json.JSONDecoder().raw_decode(text)[0]
+    except json.JSONDecodeError:
+        try:
+            result = parse_partial_json(re.sub(r",\s*([}\]])", r"\1", text))
+        except json.JSONDecodeError:
+            return None
+        xjson_repaired.inc()
+    return result if isinstance(result, dict) else None
+
+
+def rejected(e: BaseException) -> bool:
+    """Whether `e` is the provider refusing the request itself."""
+    if isinstance(e, BaseExceptionGroup):
+        return all(map(rejected, e.exceptions))
+    return getattr(e, "status_code", None) in (400, 422)
+
+
+def format_rejected(e: BaseException) -> bool:
+    """Whether `e` is the provider refusing the requested response format."""
+    if isinstance(e, BaseExceptionGroup):
+        return all(map(format_rejected, e.exceptions))
+    text = str(e).lower()
+    return rejected(e) and any(
+        word in text for word in ("response_format", "json", "schema", "structured")
+    )
+
+
+def model_format(model, schema: dict | None) -> str:
+    first = 0 if schema else 1
+    index, until = formats.get(id(model), (first, 0))
+    if until and time() >= until:
+        del formats[id(model)]
+        index = first
+    return FORMATS[max(index, first)]
+
+
+def response_format(mode: str, name: str, schema: dict | None) -> dict | None:
+    if mode == "json_schema" and schema:
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": name, "schema": schema},
+        }
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+async def llm_xjson(
+    model: LanguageModelLike, msg, schema: dict | None = None, name: str = "output"
+) -> dict:
+    """
+    Invoke `model` for a JSON object, asking for `schema`-constrained or JSON
+    mode output where the provider supports it and repairing what comes back.
+    """
     for retry in range(10):
-        logger.info("llm_xjson invoking llm")
+        mode = model_format(model, schema)
+        fmt = response_format(mode, name, schema)
+        logger.info(f"llm_xjson invoking llm for {mode} output")
+        xjson_calls.inc(format=mode)
         try:
-            ret = await model.ainvoke(msg)
-        except Exception:
+            bound = model.bind(response_format=fmt) if fmt else model  # type: ignore
+            ret = await bound.ainvoke(msg)
+        except Exception as e:
+            if mode != "text" and format_rejected(e):
+                logger.warning(f"llm_xjson {mode} output rejected: {e}")
+                formats[id(model)] = (FORMATS.index(mode) + 1, time() + FORMAT_RETRY)
+                xjson_retries.inc(reason="format")
+                continue
+            if rejected(e):
+                # the same request would only be refused again
+                logger.error(f"llm_xjson request rejected: {e}")
+                raise
             logger.error(f"llm_xjson llm invoke error: {traceback.format_exc()}")
+            xjson_retries.inc(reason="invoke")
             await asyncio.sleep(retry + 3)
-        text = ret.text  # type: ignore
+            continue
+        text = ret.text
         logger.info(f"llm_xjson llm returned: {text}")
-        try:
-            result = json.loads(extract_json(remove_code_blocks(text)))
+        if (result := parse_json(text)) is not None:
             return result
-        except json.JSONDecodeError as e:
-            logger.warning(
-                f"llm_xjson JSONDecodeError: {e}: llm returned invalid json: {text}"
-            )
+        logger.warning(f"llm_xjson llm returned invalid json: {text}")
+        xjson_retries.inc(reason="parse")
     raise Exception("llm_xjson: too many retries")
 
 
-chroma = make_chroma("memorying", DATADIR + "/chroma")
+chroma = make_chroma(
+    "memorying",
+    DATADIR + "/chroma",
+    quantize=ENV.get("MEMORY_QUANTIZE") or None,
+    backend=ENV.get("MEMORY_BACKEND") or "chroma",
+)
 
 
-async def extract_facts(model: LanguageModelLike, msgs: list[AnyMessage]) -> list[str]:
-    try:
-        result = await llm_xjson(
-            model,
-            msgs
-            + [
-                SystemMessage(MEMORY_EXTRACTION_PROMPT.format(date=get_date())),
-                HumanMessage("直接输出结果："),
-            ],
+# Memories carry flat metadata, which Chroma and the brute-force stores can
+# both filter on: `time` stored, `chat` as "group:<id>" or "private:<id>", a
+# `user:<id>` flag for each person involved and their number as `users`, so
+# memories about nobody in particular can be found too.
+QQ_ID = re.compile(r"\d{5,}")
+CHAT = re.compile(r"(group|private):(\d+)")
+
+
+def count_users(meta: dict) -> dict | None:
+    """`meta` with its `users` count, or None if it has one."""
+    if "users" in meta:
+        return None
+    return {**meta, "users": sum(k.startswith("user:") for k in meta)}
+
+
+# memories stored before `users` existed are counted once, on the first start
+if counted := backfill_metadata(chroma, count_users):
+    logger.info(f"counted the users of {counted} memories")
+
+
+def fact_metadata(fact: dict, seen: set[str], when: float) -> dict:
+    """Metadata of an extracted fact, keeping only ids seen in its window."""
+    meta: dict = {"time": when}
+    chat = str(fact.get("chat") or "")
+    if (m := CHAT.fullmatch(chat)) and m[2] in seen:
+        meta["chat"] = chat
+    users = fact.get("users")
+    for user in users if isinstance(users, list) else []:
+        if str(user) in seen:
+            meta[f"user:{user}"] = True
+    meta["users"] = sum(k.startswith("user:") for k in meta)
+    return meta
+
+
+def merge_metadata(metadatas: list[dict]) -> dict:
+    """
+    Metadata of a memory written from several facts or memories: all of
+    their users, their chat if they agree on one, and the latest time.
+    """
+    meta: dict = {
+        k: v for m in metadatas for k, v in m.items() if k.startswith("user:")
+    }
+    meta["users"] = len(meta)
+    times = [m["time"] for m in metadatas if "time" in m]
+    if times:
+        meta["time"] = max(times)
+    chats = {m["chat"] for m in metadatas if "chat" in m}
+    if len(chats) == 1:
+        meta["chat"] = chats.pop()
+    return meta
+
+
+def memory_filter(
+    users: Sequence[str] = (), chat: str | None = None, since: float | None = None
+) -> dict | None:
+    """
+    Search filter for memories involving any of `users` or nobody in
+    particular, from `chat`, stored at or after `since`, e.g.
+    `memory_filter(["123"], "group:456", time() - 30 * 86400)`.
+    """
+    conds: list[dict] = []
+    if users:
+        conds.append({"$or": [{f"user:{u}": True} for u in users] + [{"users": 0}]})
+    if chat:
+        conds.append({"chat": chat})
+    if since is not None:
+        conds.append({"time": {"$gte": since}})
+    if len(conds) > 1:
+        return {"$and": conds}
+    return conds[0] if conds else None
+
+
+async def search_memories(
+    queries: list[str],
+    k: int = 4,
+    users: Sequence[str] = (),
+    chat: str | None = None,
+    since: float | None = None,
+    embeddings: Sequence[Sequence[float]] | None = None,
+) -> list[list[Document]]:
+    return await amax_marginal_relevance_search_many(
+        chroma,
+        queries,
+        k,
+        filter=memory_filter(users, chat, since),
+        embeddings=embeddings,
+    )
+
+
+async def search_facts(facts: list[str], metadatas: list[dict]) -> list[list[Document]]:
+    """
+    Memories near each fact among those about any of its people or nobody in
+    particular, so a fact about one person is never merged into another's
+    memories. The facts are embedded once, then searched with one filtered
+    search per distinct set of users.
+    """
+    if not facts:
+        return []
+    vectors = await chroma.embeddings.aembed_documents(facts)  # type: ignore
+    groups: dict[tuple[str, ...], list[int]] = {}
+    for i, meta in enumerate(metadatas):
+        users = tuple(sorted(k[5:] for k in meta if k.startswith("user:")))
+        groups.setdefault(users, []).append(i)
+    found = await asyncio.gather(
+        *(
+            search_memories(
+                [facts[i] for i in group],
+                users=users,
+                embeddings=[vectors[i] for i in group],
+            )
+            for users, group in groups.items()
         )
-        return list(map(str.strip, result.get("facts", [])))
-    except Exception as e:
-        logger.error(f"fact extraction failed: {e}")
-    return []
+    )
+    results: list[list[Document]] = [[] for _ in facts]
+    for group, docs in zip(groups.values(), found):
+        for i, d in zip(group, docs):
+            results[i] = d
+    return results
+
+
+async def extract_facts(
+    model: LanguageModelLike, msgs: list[AnyMessage], when: float | None = None
+) -> tuple[list[str], list[dict]]:
+    """Facts in `msgs` and their metadata, timed `when` or now."""
+    result = await llm_xjson(
+        model,
+        msgs
+        + [
+            SystemMessage(MEMORY_EXTRACTION_PROMPT.format(date=get_date())),
+            HumanMessage("直接输出结果："),
+        ],
+        FACTS_SCHEMA,
+        "facts",
+    )
+    seen = set(QQ_ID.findall("\n".join(m.text for m in msgs)))
+    facts = []
+    metadatas = []
+    for fact in result.get("facts", []):
+        if isinstance(fact, str):
+            fact = {"text": fact}
+        if not isinstance(fact, dict) or not str(fact.get("text", "")).strip():
+            continue
+        facts.append(str(fact["text"]).strip())
+        metadatas.append(fact_metadata(fact, seen, when or time()))
+    return facts, metadatas
+
+
+DUP_SIMILARITY = float(ENV.get("MEMORY_DUP_SIMILARITY", "0.95"))
+
+
+def normalize_fact(text: str) -> str:
+    """Casefolded NFKC text without whitespace, punctuation or symbols."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return "".join(c for c in text if unicodedata.category(c)[0] not in "PSZC")
+
+
+async def new_facts(facts: list[str], results: list[list]) -> list[int]:
+    """
+    Indices of the facts that may change memory: neither a normalized
+    restatement of another fact or of one of its retrieved memories, nor
+    within `DUP_SIMILARITY` cosine similarity of one of those memories.
+    """
+    seen = set()
+    candidates = []
+    for i, fact in enumerate(facts):
+        key = normalize_fact(fact)
+        if (
+            key
+            and key not in seen
+            and all(normalize_fact(doc.page_content) != key for doc in results[i])
+        ):
+            candidates.append(i)
+        seen.add(key)
+    texts = list(
+        dict.fromkeys(
+            [facts[i] for i in candidates]
+            + [doc.page_content for i in candidates for doc in results[i]]
+        )
+    )
+    if DUP_SIMILARITY >= 1 or not any(results[i] for i in candidates):
+        return candidates
+    # facts were embedded for the search and memories when stored, so these
+    # normally come straight from the embedding cache
+    vectors = dict(zip(texts, await chroma.embeddings.aembed_documents(texts)))  # type: ignore
+    fresh = []
+    for i in candidates:
+        fact = np.asarray(vectors[facts[i]], dtype=np.float32)
+        memories = np.array(
+            [vectors[doc.page_content] for doc in results[i]], dtype=np.float32
+        )
+        if len(memories):
+            sims = memories @ fact
+            sims /= np.linalg.norm(memories, axis=1) * np.linalg.norm(fact)
+            if sims.max() >= DUP_SIMILARITY:
+                continue
+        fresh.append(i)
+    return fresh
 
 
-async def update_memory(facts: list[str], results: list):
+async def update_memory(facts: list[str], results: list, metadatas: list[dict]):
+    if len(facts) == 0:
+        return
     if len(results) == 0:
-        await chroma.aadd_texts(list(facts))
+        await chroma.aadd_texts(list(facts), metadatas)
         return
-    prompt = get_update_memory_messages(
+    by_text = dict(zip(facts, metadatas))
+    # without its source facts a memory is timed and placed, but not tagged
+    # with users, which could belong to any fact in this update
+    untagged = merge_metadata(
+        [{k: v for k, v in m.items() if not k.startswith("user:")} for m in metadatas]
+    )
+    prompt = update_memory_messages(
         [{"id": str(i[0]), "text": i[1].page_content} for i in enumerate(results)],
-        list(facts),
+        [{"index": i, "text": fact} for i, fact in enumerate(facts)],
     )
     logger.info("sending memory update query")
-    actions = (await llm_xjson(llm2, prompt)).get("memory", [])
+    actions = (await llm_xjson(llm, prompt, MEMORY_SCHEMA, "memory")).get("memory", [])
     adds = []
+    add_metas = []
     update_ids = []
     updates = []
+    update_metas = []
     deletes = []
     for action in actions:
         text = action.get("text").strip()
@@ -135,16 +706,28 @@ async def update_memory(facts: list[str], results: list):
             continue
         event = action.get("event")
         idx = action.get("id")
+        source = action.get("facts")
+        sources = [
+            metadatas[int(i)]
+            for i in (source if isinstance(source, list) else [])
+            if str(i).isdigit() and int(i) < len(facts)
+        ]
+        if sources:
+            meta = merge_metadata(sources)
+        else:
+            meta = by_text.get(text, untagged)
         if event == "ADD":
             adds.append(text)
+            add_metas.append(meta)
             continue
         if isinstance(idx, str) and idx.isdigit():
             idx = int(idx)
-        elif not isinstance(idx, int):
+        if not isinstance(idx, int) or not 0 <= idx < len(results):
             continue
         if event == "UPDATE":
             update_ids.append(results[idx].id)
             updates.append(text)
+            update_metas.append(merge_metadata([results[idx].metadata or {}, meta]))
         elif event == "DELETE":
             deletes.append(results[idx].id)
     logger.info(f"adds: {adds} updates: {updates} deletes: {deletes}")
@@ -152,27 +735,57 @@ async def update_memory(facts: list[str], results: list):
     if len(deletes) > 0:
         await chroma.adelete(deletes)
     if len(adds) > 0:
-        await chroma.aadd_texts(adds)
+        await chroma.aadd_texts(adds, add_metas)
     if len(updates) > 0:
-        await chroma.aadd_texts(updates, ids=update_ids)
+        await chroma.aadd_texts(updates, update_metas, ids=update_ids)
     return
 
 
-@task
-async def process_memory(model: LanguageModelLike, msgs: list[AnyMessage]):
+async def remember(
+    model: LanguageModelLike, msgs: list[AnyMessage], when: float | None = None
+):
+    """Extract facts from `msgs` and merge them into memory, raising on failure."""
+    try:
+        await _remember(model, msgs, when)
+    finally:
+        export_metrics()
+
+
+async def _remember(
+    model: LanguageModelLike, msgs: list[AnyMessage], when: float | None = None
+):
     logger.info("process_memory start")
-    facts = await extract_facts(model, msgs)
+    facts, metadatas = await extract_facts(model, msgs, when)
     logger.info(f"extracted facts: {facts}")
-    ths = [chroma.asearch(fact, "mmr") for fact in facts]
-    search_results = await asyncio.gather(*ths)
+    if not facts:
+        logger.info("process_memory finish, no facts")
+        return
+    search_results = await search_facts(facts, metadatas)
+    fresh = await new_facts(facts, search_results)
+    if len(fresh) < len(facts):
+        known = [facts[i] for i in range(len(facts)) if i not in fresh]
+        logger.info(f"skipping already known facts: {known}")
+    if not fresh:
+        logger.info("process_memory finish, nothing new")
+        return
     unique_results = list(
-        {doc.id: doc for doc_ in search_results for doc in doc_}.values()
+        {doc.id: doc for i in fresh for doc in search_results[i]}.values()
     )
     logger.info(f"searched existing memories: {unique_results}")
-    await update_memory(facts, list(unique_results))
+    await update_memory(
+        [facts[i] for i in fresh], unique_results, [metadatas[i] for i in fresh]
+    )
     logger.info("process_memory finish")
 
 
+@task
+async def process_memory(model: LanguageModelLike, msgs: list[AnyMessage]):
+    try:
+        await remember(model, msgs)
+    except Exception as e:
+        logger.error(f"process_memory failed: {e}")
+
+
 def main():
     @entrypoint()
     async def test_main(_):
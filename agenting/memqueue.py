@@ -0,0 +1,209 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import traceback
+from collections.abc import Awaitable, Callable
+from time import time
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelResponse,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from components import llm
+from config import *
+from .memorying import remember
+
+logger = get_log(__name__)
+
+
+def to_langchain(msgs: list[ModelMessage]) -> list[AnyMessage]:
+    """
+    The user prompts, tool returns and responses of `msgs` as plain langchain
+    messages for the memory extraction prompt. System prompts are left out.
+    """
+    ret = []
+    for msg in msgs:
+        if isinstance(msg, ModelResponse):
+            lines = [msg.text] if msg.text else []
+            lines += [f"{c.tool_name}({c.args_as_json_str()})" for c in msg.tool_calls]
+            if lines:
+                ret.append(AIMessage("\n".join(lines)))
+            continue
+        for part in msg.parts:
+            if isinstance(part, UserPromptPart):
+                content = part.content
+                if not isinstance(content, str):
+                    content = "\n".join(c for c in content if isinstance(c, str))
+                if content:
+                    ret.append(HumanMessage(content))
+            elif isinstance(part, ToolReturnPart):
+                ret.append(
+                    HumanMessage(f"{part.tool_name}: {part.model_response_str()}")
+                )
+    return ret
+
+
+class MemoryQueue:
+    """
+    Message windows waiting for memory processing, persisted in SQLite so
+    pending work survives restarts, and the workers that drain them.
+
+    `put` only writes a row, in a worker thread, and never waits for
+    processing. At most `workers` windows are processed at once; a failed
+    window is retried after an exponential backoff until it has been tried
+    `max_attempts` times. When more than `max_pending` windows are waiting,
+    the oldest are dropped, each with a warning.
+    """
+
+    BACKOFF = 30
+    MAX_BACKOFF = 3600
+
+    def __init__(
+        self,
+        path: str,
+        process: Callable[[list[ModelMessage]], Awaitable[None]],
+        workers: int = 2,
+        max_pending: int = 64,
+        max_attempts: int = 5,
+    ) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.process = process
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS windows (id INTEGER PRIMARY KEY,"
+            " messages BLOB NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " not_before REAL NOT NULL DEFAULT 0)"
+        )
+        self.running: set[int] = set()
+        self.wakeup: asyncio.Event | None = None
+        self.tasks: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM windows").fetchone()[0]
+
+    async def put(self, msgs: list[ModelMessage]):
+        if not msgs:
+            return
+        await asyncio.to_thread(self._insert, msgs)
+        if self.wakeup:
+            self.wakeup.set()
+
+    def _insert(self, msgs: list[ModelMessage]):
+        data = ModelMessagesTypeAdapter.dump_json(msgs)
+        with self.lock:
+            self.db.execute("INSERT INTO windows (messages) VALUES (?)", (data,))
+            dropped = self.db.execute(
+                "SELECT id, attempts FROM windows"
+                f" WHERE id NOT IN ({','.join('?' * len(self.running))})"
+                " ORDER BY id DESC LIMIT -1 OFFSET ?",
+                (*self.running, self.max_pending),
+            ).fetchall()
+            self.db.executemany(
+                "DELETE FROM windows WHERE id = ?", [(id,) for id, _ in dropped]
+            )
+        for id, attempts in dropped:
+            logger.warning(
+                f"memory queue full, dropped window {id} after {attempts} attempts"
+            )
+
+    def start(self):
+        """Start the workers on the running event loop."""
+        self.wakeup = asyncio.Event()
+        self.tasks = [
+            asyncio.create_task(self._worker(), name=f"memory-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"memory queue started with {len(self)} pending windows")
+
+    async def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def _claim(self) -> tuple[int, bytes, int] | float | None:
+        """The next due window, or the time the next one becomes due."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, messages, attempts, not_before FROM windows"
+                f" WHERE id NOT IN ({','.join('?' * len(self.running))})"
+                " ORDER BY not_before, id LIMIT 1",
+                tuple(self.running),
+            ).fetchall()
+            if not rows:
+                return None
+            id, messages, attempts, not_before = rows[0]
+            if not_before > time():
+                return not_before
+            self.running.add(id)
+            return id, messages, attempts
+
+    async def _worker(self):
+        assert self.wakeup
+        while True:
+            job = self._claim()
+            if job is None or isinstance(job, float):
+                self.wakeup.clear()
+                timeout = None if job is None else job - time()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except TimeoutError:
+                    pass
+                continue
+            id, messages, attempts = job
+            try:
+                await self.process(ModelMessagesTypeAdapter.validate_json(messages))
+            except Exception:
+                attempts += 1
+                logger.error(
+                    f"memory window {id} failed ({attempts}/{self.max_attempts}):"
+                    f" {traceback.format_exc()}"
+                )
+                with self.lock:
+                    if attempts >= self.max_attempts:
+                        self.db.execute("DELETE FROM windows WHERE id = ?", (id,))
+                    else:
+                        delay = min(
+                            self.BACKOFF * 2 ** (attempts - 1), self.MAX_BACKOFF
+                        )
+                        self.db.execute(
+                            "UPDATE windows SET attempts = ?, not_before = ?"
+                            " WHERE id = ?",
+                            (attempts, time() + delay, id),
+                        )
+            else:
+                with self.lock:
+                    self.db.execute("DELETE FROM windows WHERE id = ?", (id,))
+            finally:
+                self.running.discard(id)
+            # another worker may be sleeping on this window's retry time
+            self.wakeup.set()
+
+
+async def remember_window(msgs: list[ModelMessage]):
+    # memories are timed by the window, not by when a worker got to it
+    when = max(
+        (m.timestamp.timestamp() for m in msgs if isinstance(m, ModelResponse)),
+        default=None,
+    )
+    await remember(llm, to_langchain(msgs), when)
+
+
+memory_queue = MemoryQueue(
+    DATADIR + "/memory_queue.sqlite3",
+    remember_window,
+    workers=int(ENV.get("MEMORY_WORKERS", "2")),
+    max_pending=int(ENV.get("MEMORY_QUEUE_SIZE", "64")),
+    max_attempts=int(ENV.get("MEMORY_ATTEMPTS", "5")),
+)
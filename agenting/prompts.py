@@ -1,44 +1,85 @@
-import json
 from langchain.messages import (
     SystemMessage,
     HumanMessage,
 )
-from pydantic_ai import ModelMessage, SystemPromptPart, UserPromptPart, ModelRequest
+from pydantic_ai import (
+    CachePoint,
+    ModelMessage,
+    SystemPromptPart,
+    UserPromptPart,
+    ModelRequest,
+)
+from typing import Any, Callable
 from agenting.types import BotDeps, BotState
+from agenting.tools import notes
 from config import *
 from components import langfuse
+from promptcache import CachedPrompt
+
+system_prompt = CachedPrompt(
+    langfuse, "system-prompt", float(ENV.get("PROMPT_TTL", "300"))
+)
+
+# the last messages built for each kind of prompt, with the inputs they were
+# built from; the same inputs get the same messages back without rebuilding
+_built: dict[str, tuple[Any, list[ModelMessage]]] = {}
+
+
+def _memoized(
+    kind: str, key: Any, build: Callable[[], list[ModelMessage]]
+) -> list[ModelMessage]:
+    if (hit := _built.get(kind)) is None or hit[0] != key:
+        hit = _built[kind] = (key, build())
+    return list(hit[1])
 
 
 def initial_prompts(deps: BotDeps, state: BotState) -> list[ModelMessage]:
-    system_prompt = langfuse.get_prompt("system-prompt").prompt
-
-    try:
-        with open(DATADIR + "/note.json", "r") as f:
-            note = json.load(f)
-        if not isinstance(note, list):
-            note = []
-    except (json.JSONDecodeError, FileNotFoundError):
-        note = []
-    notes = [f"{i + 1} {n}" for i, n in enumerate(note)]
-    if len(notes) == 0:
-        notes = "当前无笔记"
-    else:
-        notes = "\n".join(notes)
+    """
+    The head of every request, least often changed first so providers can
+    reuse its cached prefix: system prompt, applet instructions, then the
+    summary, which changes only together with the history after it. A cache
+    point closes it for providers with explicit prompt caching.
+    """
+    key = (system_prompt.get(), deps.applet_instructions, state.summary)
+    return _memoized("head", key, lambda: _head(*key))
 
+
+def _head(system: str, instructions: str, summary: str | None):
     return [
         ModelRequest(
             [
                 SystemPromptPart(
                     "\n".join(
                         [
-                            system_prompt,
-                            deps.applet_instructions,
-                            f"当前你的笔记内容(按需使用`edit_note`编辑笔记):\n```\n{notes}\n```\n",
-                            f"之前的交互历史摘要:\n```\n{state.summary}\n```\n",
+                            system,
+                            instructions,
+                            f"之前的交互历史摘要:\n```\n{summary}\n```\n",
                         ]
                     )
                 ),
-                UserPromptPart("输出你的逐步推理思考过程，并调用工具执行动作:"),
+                UserPromptPart(
+                    ["输出你的逐步推理思考过程，并调用工具执行动作:", CachePoint()]
+                ),
             ]
         )
     ]
+
+
+def note_prompts() -> list[ModelMessage]:
+    """The notes, which can change at any step, to go after the history."""
+    note = notes.load()
+    return _memoized("notes", notes.stat, lambda: _notes(note))
+
+
+def _notes(note: list) -> list[ModelMessage]:
+    lines = [f"{i + 1} {n}" for i, n in enumerate(note)]
+    if len(lines) == 0:
+        text = "当前无笔记"
+    else:
+        text = "\n".join(lines)
+
+    return [
+        ModelRequest.user_text_prompt(
+            f"当前你的笔记内容(按需使用`edit_note`编辑笔记):\n```\n{text}\n```\n"
+        )
+    ]
@@ -1,30 +1,66 @@
-from pydantic_ai import ModelMessage, ModelResponse, ToolDefinition, ToolReturn
+from pydantic_ai import ModelMessage, ToolDefinition
 from components import langfuse
 from pydantic_ai.models import Model
 from pydantic_ai.direct import model_request
 from pydantic_ai.models import ModelRequestParameters
-from pydantic_ai.messages import ModelRequest, SystemPromptPart, UserPromptPart
+from pydantic_ai.messages import (
+    ModelRequest,
+    RetryPromptPart,
+    SystemPromptPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from config import ENV
+from promptcache import CachedPrompt
+from .tokens import count_tokens, message_tokens, tool_tokens
 
 
-KEEP_ROUNDS = 4
+# the history is reduced once the prompt is estimated above CONTEXT_BUDGET
+# tokens, keeping the latest rounds that fit in CONTEXT_KEEP tokens
+CONTEXT_BUDGET = int(ENV.get("CONTEXT_BUDGET", "48000"))
+CONTEXT_KEEP = int(ENV.get("CONTEXT_KEEP", "12000"))
+
+reduce_prompt = CachedPrompt(
+    langfuse, "context-reduce", float(ENV.get("PROMPT_TTL", "300"))
+)
+
+
+def round_start(msg: ModelMessage) -> bool:
+    """Whether a round starts at `msg`, so cutting there splits no tool call."""
+    return isinstance(msg, ModelRequest) and not any(
+        isinstance(p, (ToolReturnPart, RetryPromptPart)) for p in msg.parts
+    )
+
+
+def find_cut(msgs: list[ModelMessage], keep: int = CONTEXT_KEEP) -> int:
+    """
+    The earliest round start after which the messages fit in `keep` tokens,
+    or the last round start if even the latest round does not fit.
+    """
+    cut = 0
+    tail = 0
+    for i in range(len(msgs) - 1, 0, -1):
+        tail += message_tokens(msgs[i])
+        if round_start(msgs[i]):
+            if tail > keep and cut:
+                break
+            cut = i
+    return cut
+
+
+def over_budget(
+    tool_defs: list[ToolDefinition],
+    msgs: list[ModelMessage],
+    budget: int = CONTEXT_BUDGET,
+) -> bool:
+    return count_tokens(msgs) + tool_tokens(tool_defs) > budget
 
 
 async def summarize(
     model: Model, tool_defs: list[ToolDefinition], msgs: list[ModelMessage]
 ):
-    reduce_prompt = langfuse.get_prompt("context-reduce").prompt
-    cut = 0
-    tail_rounds = 0
-    for i in range(len(msgs) - 2, -1, -1):
-        if (
-            isinstance(msgs[i], ModelResponse)
-            or isinstance(msgs[i].parts[0], ToolReturn)
-        ) and isinstance(msgs[i + 1], ModelRequest):
-            tail_rounds += 1
-            if tail_rounds >= KEEP_ROUNDS:
-                cut = i + 1
-                break
-    if cut <= 2:
+    cut = find_cut(msgs)
+    if cut <= 1:
         return None, None
     msgs_to_sum = msgs[:cut]
     msgs_to_keep = msgs[cut:]
@@ -35,7 +71,7 @@ async def summarize(
         + [
             ModelRequest(
                 parts=[
-                    SystemPromptPart(reduce_prompt),
+                    SystemPromptPart(reduce_prompt.get()),
                     UserPromptPart("输出提取的交互上下文摘要:"),
                 ]
             )
@@ -0,0 +1,76 @@
+import json
+import re
+from pydantic_ai import CachePoint, ModelMessage, ModelResponse, ToolDefinition
+from pydantic_ai.messages import (
+    BaseToolReturnPart,
+    RetryPromptPart,
+    SystemPromptPart,
+    TextPart,
+    ThinkingPart,
+    ToolCallPart,
+    UserPromptPart,
+)
+
+# tokenizers give CJK text about a token per character and other text about
+# one per four characters; images are billed at a flat rate by most providers
+CJK = re.compile("[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+MESSAGE_OVERHEAD = 4
+MEDIA_TOKENS = 1000
+
+
+def text_tokens(text: str) -> int:
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _count(msg: ModelMessage) -> int:
+    n = MESSAGE_OVERHEAD
+    if isinstance(msg, ModelResponse):
+        for part in msg.parts:
+            if isinstance(part, (TextPart, ThinkingPart)):
+                n += text_tokens(part.content)
+            elif isinstance(part, ToolCallPart):
+                n += text_tokens(part.tool_name + part.args_as_json_str())
+        return n
+    for part in msg.parts:
+        if isinstance(part, SystemPromptPart):
+            n += text_tokens(part.content)
+        elif isinstance(part, UserPromptPart):
+            content = part.content
+            for c in [content] if isinstance(content, str) else content:
+                if isinstance(c, str):
+                    n += text_tokens(c)
+                elif not isinstance(c, CachePoint):
+                    n += MEDIA_TOKENS
+        elif isinstance(part, BaseToolReturnPart):
+            n += text_tokens(part.model_response_str())
+        elif isinstance(part, RetryPromptPart):
+            n += text_tokens(part.model_response())
+    return n
+
+
+def message_tokens(msg: ModelMessage) -> int:
+    """
+    Estimated prompt tokens of `msg`, counted once and kept on the message;
+    messages are never changed after they are added to the history.
+    """
+    n = getattr(msg, "_tokens", None)
+    if n is None:
+        n = _count(msg)
+        msg._tokens = n  # type: ignore
+    return n
+
+
+def count_tokens(msgs: list[ModelMessage]) -> int:
+    return sum(message_tokens(m) for m in msgs)
+
+
+def tool_tokens(tool_defs: list[ToolDefinition]) -> int:
+    return sum(
+        text_tokens(
+            t.name
+            + (t.description or "")
+            + json.dumps(t.parameters_json_schema, ensure_ascii=False)
+        )
+        for t in tool_defs
+    )
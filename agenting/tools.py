@@ -1,15 +1,21 @@
+import asyncio
 import json
+from typing import Any
 from config import *
 from .types import BotDeps
 from utils import get_date
 from time import time
 from pydantic import BaseModel, field_validator
-from pydantic_ai.toolsets import FunctionToolset
+from pydantic_ai import AbstractToolset, RunContext, ToolCallPart
+from pydantic_ai.toolsets import FunctionToolset, ToolsetTool
+from promptcache import NoteFile
 
 logger = get_log(__name__)
 
 local_toolset = FunctionToolset[BotDeps]()
 
+notes = NoteFile(DATADIR + "/note.json")
+
 
 class EditNoteInput(BaseModel):
     adds: list[str] | None
@@ -44,13 +50,7 @@ async def edit_note(args: EditNoteInput):
     """
     adds = args.adds
     deletes = args.deletes
-    try:
-        with open(DATADIR + "/note.json", "r+") as f:
-            note = json.load(f)
-        if not isinstance(note, list):
-            note = []
-    except (json.JSONDecodeError, FileNotFoundError):
-        note = []
+    note = notes.load()
     if deletes:
         delset = sorted(map(int, deletes), reverse=True)
         for num in delset:
@@ -60,6 +60,55 @@ async def edit_note(args: EditNoteInput):
     if adds:
         date = get_date()
         note += [f"[{date}] {content}" for content in adds]
-    with open(DATADIR + "/note.json", "w") as f:
-        json.dump(note, f, ensure_ascii=False, indent=2)
+    notes.save(note)
     return "Success."
+
+
+# tools without side effects that matter to other calls, run concurrently;
+# MCP tools opt in with the `readOnlyHint` annotation
+READ_ONLY_TOOLS = {
+    "get_chats",
+    "get_messages",
+    "get_messages_by_id",
+    "unwrap_forward",
+    "ask_image",
+}
+
+
+def read_only(tool: ToolsetTool[BotDeps]) -> bool:
+    annotations = (tool.tool_def.metadata or {}).get("annotations") or {}
+    return tool.tool_def.name in READ_ONLY_TOOLS or bool(
+        annotations.get("readOnlyHint")
+    )
+
+
+async def run_tools(
+    toolset: AbstractToolset[BotDeps],
+    tools: dict[str, ToolsetTool[BotDeps]],
+    calls: list[ToolCallPart],
+    ctx: RunContext[BotDeps],
+) -> list[Any]:
+    """
+    Results of `calls`, in call order. Runs of consecutive read-only calls run
+    concurrently; any other call waits for all calls before it and runs alone.
+    """
+    results = []
+    batch: list[ToolCallPart] = []
+
+    def call(c: ToolCallPart):
+        return toolset.call_tool(c.tool_name, c.args_as_dict(), ctx, tools[c.tool_name])
+
+    async def flush():
+        if len(batch) > 1:
+            logger.info(f"running {len(batch)} read-only tools concurrently")
+        results.extend(await asyncio.gather(*map(call, batch)))
+        batch.clear()
+
+    for c in calls:
+        if read_only(tools[c.tool_name]):
+            batch.append(c)
+        else:
+            await flush()
+            results.append(await call(c))
+    await flush()
+    return results
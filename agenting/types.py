@@ -3,13 +3,19 @@ from typing import TypedDict
 from langgraph.graph import add_messages
 from langgraph.runtime import Runtime
 from langchain_core.messages import AnyMessage
-from pydantic_ai import AbstractToolset
+import asyncio
+from time import time
+from pydantic_ai import AbstractToolset, RunContext, ToolDefinition
+from pydantic_ai.mcp import MCPServer
+from pydantic_ai.toolsets import ToolsetTool
 from applet.base import BaseApplet
 from config import *
 from typing import Annotated
 from langchain.tools import ToolRuntime, BaseTool
 from pydantic_ai.messages import ModelMessage
 
+logger = get_log(__name__)
+
 
 @dataclass
 class BotState:
@@ -21,10 +27,67 @@ class BotState:
     tire_level: float = field(default=0)
 
 
+TOOLS_TTL = float(ENV.get("TOOLS_TTL", "300"))
+
+
+@dataclass
+class ToolCatalogue:
+    """
+    Tools of a toolset and their definitions, listed once and reused until
+    `ttl` seconds pass or an MCP server drops its cached tool list, which it
+    does on a `tools/list_changed` notification or a reconnect.
+    """
+
+    toolset: AbstractToolset["BotDeps"]
+    ttl: float = TOOLS_TTL
+    tools: dict[str, ToolsetTool["BotDeps"]] = field(default_factory=dict)
+    tool_defs: list[ToolDefinition] = field(default_factory=list)
+    expires: float = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def __post_init__(self):
+        # servers with `cache_tools=False` never keep a list to drop, so
+        # only the ttl refreshes their tools
+        self.servers: list[MCPServer] = []
+        self.toolset.apply(
+            lambda t: (
+                self.servers.append(t)
+                if isinstance(t, MCPServer) and t.cache_tools
+                else None
+            )
+        )
+
+    def invalidate(self):
+        self.expires = 0
+
+    def _stale(self) -> bool:
+        # NOTE pydantic-ai 1.41 has no public way to see that a server dropped
+        # its tool list, so peek at `_cached_tools`; if it goes away, fall
+        # back to the ttl
+        return time() >= self.expires or any(
+            getattr(s, "_cached_tools", ()) is None for s in self.servers
+        )
+
+    async def get(
+        self, ctx: RunContext["BotDeps"]
+    ) -> tuple[dict[str, ToolsetTool["BotDeps"]], list[ToolDefinition]]:
+        async with self.lock:
+            if self._stale():
+                self.tools = await self.toolset.get_tools(ctx)
+                self.tool_defs = [t.tool_def for t in self.tools.values()]
+                self.expires = time() + self.ttl
+                logger.info(f"listed {len(self.tools)} tools")
+        return self.tools, self.tool_defs
+
+
 @dataclass
 class BotDeps:
     toolset: AbstractToolset["BotDeps"]
     applet_instructions: str
+    catalogue: ToolCatalogue = field(init=False)
+
+    def __post_init__(self):
+        self.catalogue = ToolCatalogue(self.toolset)
 
 
 GraphRt = Runtime[BotDeps]
@@ -1,9 +1,19 @@
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from importlib.util import find_spec
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
 import uvicorn
 import httpx
 import asyncio
-import json
+import orjson
 from os import environ
+from time import monotonic
+from health import Attempt, Health, HealthBoard, is_upstream_fault
+from respcache import ResponseCache, parse_ttls
+from metrics import Counter, Gauge, Histogram, Registry
+from batching import EmbeddingBatcher
 from dotenv import load_dotenv
 from logging import getLogger
 import logging
@@ -13,10 +23,21 @@ logger = getLogger(__name__)
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
-fapi = FastAPI()
 timeout = httpx.Timeout(connect=10, read=20, write=20, pool=30)
+limits = httpx.Limits(
+    max_connections=int(environ.get("APIMUX_POOL_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(environ.get("APIMUX_POOL_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(environ.get("APIMUX_POOL_KEEPALIVE_EXPIRY", "60")),
+)
 
+hedge = environ.get("APIMUX_HEDGE", "1") != "0"
+hedge_percentile = float(environ.get("APIMUX_HEDGE_PERCENTILE", "0.9"))
+hedge_delay = float(environ.get("APIMUX_HEDGE_DELAY", "3"))
+hedge_min_samples = int(environ.get("APIMUX_HEDGE_MIN_SAMPLES", "10"))
 
+
+# HTTP/2 upstream connections need the h2 package (`pip install httpx[http2]`),
+# which is not a dependency; enable them with APIMUX_HTTP2=1 or LLM<i>_HTTP2=1
 def collect_llms():
     llms = []
     for i in range(1, 100):
@@ -27,81 +48,554 @@ def collect_llms():
                     "model": environ.get(f"LLM{i}_MODEL"),
                     "api_key": environ.get(f"LLM{i}_API_KEY"),
                     "base_url": environ.get(f"LLM{i}_BASE_URL"),
+                    "http2": environ.get(
+                        f"LLM{i}_HTTP2", environ.get("APIMUX_HTTP2", "0")
+                    )
+                    != "0",
                 }
             )
     return llms
 
 
 llms = collect_llms()
+clients: dict[int, httpx.AsyncClient] = {}
 
 
-async def request_llm(request: Request, llm: dict):
-    method = request.method
-    path = request.path_params["path"]
-    body = await request.json() if await request.body() else None
+def make_client(llm: dict) -> httpx.AsyncClient:
+    http2 = llm["http2"]
+    if http2 and find_spec("h2") is None:
+        logger.warning(f"llm{llm['index']}: h2 not installed, falling back to http/1.1")
+        http2 = False
+    return httpx.AsyncClient(
+        base_url=llm["base_url"].rstrip("/") + "/",
+        headers={"Authorization": f"Bearer {llm['api_key']}"},
+        timeout=timeout,
+        limits=limits,
+        http2=http2,
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for llm in llms:
+        clients[llm["index"]] = make_client(llm)
+    await asyncio.to_thread(cache.prune)
+    try:
+        yield
+    finally:
+        await asyncio.gather(*(c.aclose() for c in clients.values()))
+        clients.clear()
+
+
+fapi = FastAPI(lifespan=lifespan)
+
+
+board = HealthBoard(
+    failures=int(environ.get("APIMUX_BREAKER_FAILURES", "3")),
+    error_rate=float(environ.get("APIMUX_BREAKER_ERROR_RATE", "0.5")),
+    cooldown=float(environ.get("APIMUX_BREAKER_COOLDOWN", "30")),
+)
+
+
+cache = ResponseCache(
+    parse_ttls(environ.get("APIMUX_CACHE_TTL", "embeddings=86400")),
+    size=int(environ.get("APIMUX_CACHE_SIZE", "1024")),
+    directory=environ.get("APIMUX_CACHE_DIR") or None,
+)
+
+
+registry = Registry()
+requests_total = registry.add(
+    Counter(
+        "apimux_requests_total", "Client requests by path and how they were served."
+    )
+)
+requests_inflight = registry.add(
+    Gauge("apimux_requests_inflight", "Client requests being served.")
+)
+upstream_requests = registry.add(
+    Counter("apimux_upstream_requests_total", "Requests sent to each upstream.")
+)
+upstream_inflight = registry.add(
+    Gauge("apimux_upstream_inflight", "Requests in flight to each upstream.")
+)
+upstream_latency = registry.add(
+    Histogram(
+        "apimux_upstream_latency_seconds",
+        "Latency of successful upstream responses, to the first delta for streams.",
+        [0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64],
+    )
+)
+upstream_wins = registry.add(
+    Counter("apimux_upstream_wins_total", "Races won by each upstream.")
+)
+upstream_failures = registry.add(
+    Counter("apimux_upstream_failures_total", "Failed upstream requests by reason.")
+)
+upstream_cancelled = registry.add(
+    Counter("apimux_upstream_cancelled_total", "Losing upstream requests cancelled.")
+)
+upstream_tokens = registry.add(
+    Counter("apimux_upstream_tokens_total", "Tokens reported by winning responses.")
+)
+wasted_tokens = registry.add(
+    Counter(
+        "apimux_wasted_tokens_total",
+        "Estimated tokens billed for losing requests: the winner's prompt tokens "
+        "per cancelled loser, the full usage of losers that also finished.",
+    )
+)
+embedding_batch = registry.add(
+    Histogram(
+        "apimux_embedding_batch_inputs",
+        "Inputs per batched upstream embedding request.",
+        [1, 2, 4, 8, 16, 32, 64, 128],
+    )
+)
+circuit_state = registry.add(
+    Gauge("apimux_circuit_state", "Upstream circuit, 0 closed, 1 half-open, 2 open.")
+)
+
+
+def upstream(llm: dict) -> str:
+    return f"llm{llm['index']}"
+
+
+def health(llm: dict) -> Health:
+    return board[upstream(llm)]
+
+
+@contextmanager
+def track(llm: dict, kind: str, attempt: Attempt):
+    name = upstream(llm)
+    upstream_requests.inc(upstream=name, kind=kind)
+    upstream_inflight.inc(upstream=name)
+    try:
+        with attempt:
+            yield attempt
+    except Exception as e:
+        upstream_failures.inc(upstream=name, reason=type(e).__name__)
+        raise
+    finally:
+        upstream_inflight.dec(upstream=name)
+
+
+def succeed(llm: dict, kind: str, attempt: Attempt):
+    attempt.success()
+    upstream_latency.observe(
+        monotonic() - attempt.started, upstream=upstream(llm), kind=kind
+    )
+
+
+def fail(llm: dict, attempt: Attempt, reason: str, fault: bool = True):
+    upstream_failures.inc(upstream=upstream(llm), reason=reason)
+    if fault:
+        attempt.failure()
+
+
+class Payload:
+    """
+    A request body parsed once, or built from `body` already parsed. The
+    `model` field is spliced in front of the rest of the body for each
+    upstream, so it is serialized only once too.
+    """
+
+    def __init__(self, raw: bytes, body=None) -> None:
+        self.raw = raw
+        if body is None and raw:
+            body = orjson.loads(raw)
+        self.body = body
+        self.rest = None
+        if isinstance(self.body, dict) and self.body.get("model") is not None:
+            self.rest = orjson.dumps(
+                {k: v for k, v in self.body.items() if k != "model"}
+            )
+
+    def for_model(self, model: str) -> bytes:
+        if self.rest is None:
+            return self.raw
+        head = b'{"model":' + orjson.dumps(model)
+        if self.rest == b"{}":
+            return head + b"}"
+        return head + b"," + self.rest[1:]
+
+
+@dataclass
+class Reply:
+    """A successful upstream response, forwarded as-is."""
+
+    content: bytes
+    media_type: str
+    usage: dict
+
+
+@dataclass
+class Rejected:
+    """An upstream refusing the request itself with a non-fault 4xx."""
+
+    status: int
+    content: bytes
+    media_type: str
+
+
+def rejection(resp: httpx.Response) -> "Rejected | None":
+    if 400 <= resp.status_code < 500 and not is_upstream_fault(resp.status_code):
+        return Rejected(
+            resp.status_code,
+            resp.content,
+            resp.headers.get("content-type", "application/json"),
+        )
+    return None
+
+
+def usage(result) -> dict:
+    return result.usage if isinstance(result, Reply) else {}
+
+
+def schedule(kind: str) -> tuple[list[dict], list[float]]:
+    """
+    Order upstreams with a closed circuit best first and give each the delay
+    to wait on it before hedging with the next one.
+    """
+    ordered = board.rank(llms, upstream, kind)
+    if not hedge:
+        return ordered, [0] * len(ordered)
+    delays = [
+        health(llm).latency(kind).percentile(hedge_percentile, hedge_min_samples)
+        or hedge_delay
+        for llm in ordered
+    ]
+    return ordered, delays
+
+
+def upstream_request(llm: dict, method: str, path: str, payload: Payload):
+    client = clients[llm["index"]]
+    content = payload.for_model(llm["model"]) if payload.raw else None
+    headers = {"Content-Type": "application/json"} if content else None
+    return client.build_request(
+        method, path, content=content, headers=headers, timeout=60
+    )
+
+
+async def request_llm(
+    llm: dict, method: str, path: str, payload: Payload, attempt: Attempt
+):
     logger.info(f"requesting llm{llm['index']}")
-    headers = httpx.Headers()
-    headers["Authorization"] = f"Bearer {llm['api_key']}"
-    headers["Content-Type"] = "application/json"
-    if isinstance(body, dict) and body.get("model") is not None:
-        body["model"] = llm["model"]
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        resp = await client.request(
-            method,
-            llm["base_url"].rstrip("/") + "/" + path,
-            json=body,
-            headers=headers,
-            timeout=60,
+    with track(llm, path, attempt):
+        resp = await clients[llm["index"]].send(
+            upstream_request(llm, method, path, payload)
         )
-        await resp.aread()
-        if resp.status_code != 200 or resp.json().get("error"):
+        data = orjson.loads(resp.content) if resp.status_code == 200 else None
+        if not isinstance(data, dict) or data.get("error"):
             logger.error(
                 f"request for llm{llm['index']} error: {resp.status_code} {resp.content.decode()}"
             )
+            if resp.status_code == 200:
+                fail(llm, attempt, "error")
+            else:
+                fail(
+                    llm,
+                    attempt,
+                    str(resp.status_code),
+                    is_upstream_fault(resp.status_code),
+                )
+            return rejection(resp)
+        succeed(llm, path, attempt)
+    used = data.get("usage")
+    return Reply(
+        resp.content,
+        resp.headers.get("content-type", "application/json"),
+        used if isinstance(used, dict) else {},
+    )
+
+
+def first_delta(buf: bytes) -> bool | None:
+    """
+    Inspect the complete SSE events in `buf`. Returns True once an event
+    carries real output, False if the stream ended or errored before that,
+    None if more bytes are needed.
+    """
+    events = buf.replace(b"\r\n", b"\n").split(b"\n\n")
+    for event in events[:-1]:
+        for line in event.split(b"\n"):
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                return False
+            try:
+                chunk = orjson.loads(data)
+            except orjson.JSONDecodeError:
+                return False
+            if not isinstance(chunk, dict) or chunk.get("error"):
+                return False
+            for choice in chunk.get("choices") or []:
+                delta = choice.get("delta") or {}
+                if (
+                    delta.get("content")
+                    or delta.get("reasoning_content")
+                    or delta.get("tool_calls")
+                ):
+                    return True
+    return None
+
+
+async def stream_llm(
+    llm: dict, method: str, path: str, payload: Payload, attempt: Attempt
+):
+    logger.info(f"streaming llm{llm['index']}")
+    client = clients[llm["index"]]
+    kind = "stream:" + path
+    with track(llm, kind, attempt):
+        resp = await client.send(
+            upstream_request(llm, method, path, payload), stream=True
+        )
+        try:
+            if resp.status_code != 200:
+                await resp.aread()
+                logger.error(
+                    f"stream for llm{llm['index']} error: {resp.status_code} {resp.content.decode()}"
+                )
+                fail(
+                    llm,
+                    attempt,
+                    str(resp.status_code),
+                    is_upstream_fault(resp.status_code),
+                )
+                await resp.aclose()
+                return rejection(resp)
+            chunks = resp.aiter_bytes()
+            buf = b""
+            async for chunk in chunks:
+                buf += chunk
+                verdict = first_delta(buf)
+                if verdict:
+                    succeed(llm, kind, attempt)
+                    return resp, buf, chunks
+                elif verdict is False:
+                    break
+            logger.error(
+                f"stream for llm{llm['index']} ended without output: {buf.decode(errors='replace')}"
+            )
+            fail(llm, attempt, "no-output")
+            await resp.aclose()
             return None
-        ret = resp.json()
-        return ret
+        except BaseException:
+            await resp.aclose()
+            raise
 
 
-@fapi.api_route("/v1/{path:path}", methods=["GET", "POST"])
-async def api_v1(request: Request):
-    pending = []
-    logger.info(f"requesting {len(llms)} models")
-    for llm in llms:
-        task = request_llm(request, llm)
-        pending.append(asyncio.create_task(task, name=f"llm{llm['index']}-request"))
+async def relay(resp: httpx.Response, head: bytes, chunks: AsyncIterator[bytes]):
+    try:
+        yield head
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await resp.aclose()
+
+
+async def close_stream(result):
+    await result[0].aclose()
+
+
+async def race(
+    kind: str,
+    starts: list[Callable[[], asyncio.Task | None]],
+    delays: list[float],
+    discard=None,
+):
+    """
+    Run `starts` in order until one returns a non-None result. Each one gets
+    its delay to finish before the next is started alongside it; a failure
+    with nothing else in flight starts the next one at once. Tasks are named
+    after their upstream. A start returning None is skipped.
+
+    When every started upstream refused the request with the same non-fault
+    status, that `Rejected` is returned, so clients see the 4xx rather than
+    an outage and can change the request.
+    """
+    pending: set[asyncio.Task] = set()
+    queued = list(zip(starts, delays))
+    deadline = 0
     result = None
     exc = []
-    while True:
+    started = 0
+    rejections: list[Rejected] = []
+    while result is None and (pending or queued):
+        while queued and (not pending or monotonic() >= deadline):
+            start, delay = queued.pop(0)
+            if (task := start()) is not None:
+                pending.add(task)
+                started += 1
+                deadline = monotonic() + delay
         if not pending:
             break
-        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        done, pending = await asyncio.wait(
+            pending,
+            timeout=max(0, deadline - monotonic()) if queued else None,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
         for d in done:
             logger.info(f"done response: {d}")
             if e := d.exception():
                 exc.append(e)
-            else:
+            elif isinstance(d.result(), Rejected):
+                rejections.append(d.result())
+            elif result is None:
                 result = d.result()
-                break
-        if result is not None:
-            break
+                if result is not None:
+                    upstream_wins.inc(upstream=d.get_name(), kind=kind)
+                    used = usage(result)
+                    for field, count in used.items():
+                        if field in ("prompt_tokens", "completion_tokens"):
+                            upstream_tokens.inc(
+                                count, upstream=d.get_name(), type=field
+                            )
+                    details = used.get("prompt_tokens_details") or {}
+                    if cached := details.get("cached_tokens"):
+                        upstream_tokens.inc(
+                            cached, upstream=d.get_name(), type="cached_tokens"
+                        )
+            elif d.result() is not None:
+                wasted_tokens.inc(
+                    usage(d.result()).get("total_tokens", 0), upstream=d.get_name()
+                )
+                if discard is not None:
+                    await discard(d.result())
+    prompt_tokens = usage(result).get("prompt_tokens", 0)
     for p in pending:
         p.cancel()
+        upstream_cancelled.inc(upstream=p.get_name(), kind=kind)
+        wasted_tokens.inc(prompt_tokens, upstream=p.get_name())
     await asyncio.gather(*pending, return_exceptions=True)
-    if result is not None:
-        return result
+    if (
+        result is None
+        and started
+        and len(rejections) == started
+        and len({r.status for r in rejections}) == 1
+    ):
+        return rejections[0]
+    return result
+
+
+def launcher(llm: dict, method: str, path: str, payload: Payload, stream: bool):
+    def start():
+        # a hedge starts well after scheduling, when another request may
+        # already be probing this upstream's half-open circuit
+        kind = "stream:" + path if stream else path
+        if (attempt := health(llm).claim(kind)) is None:
+            logger.info(f"skipping llm{llm['index']}, circuit probe in flight")
+            return None
+        logger.info(f"launching llm{llm['index']}")
+        if stream:
+            coro = stream_llm(llm, method, path, payload, attempt)
+        else:
+            coro = request_llm(llm, method, path, payload, attempt)
+        task = asyncio.create_task(coro, name=upstream(llm))
+        # a task cancelled before it runs never enters its attempt
+        task.add_done_callback(lambda _: attempt.release())
+        return task
+
+    return start
+
+
+async def forward(method: str, path: str, payload: Payload) -> Reply | Rejected | None:
+    ordered, delays = schedule(path)
+    starts = [launcher(llm, method, path, payload, False) for llm in ordered]
+    logger.info(f"requesting {len(llms)} models")
+    return await race(path, starts, delays)
+
+
+async def send_batch(body: dict) -> bytes | Rejected | None:
+    embedding_batch.observe(len(body["input"]))
+    reply = await forward("POST", "embeddings", Payload(orjson.dumps(body), body))
+    return reply.content if isinstance(reply, Reply) else reply
+
+
+batcher = EmbeddingBatcher(
+    send_batch,
+    window=float(environ.get("APIMUX_EMBED_BATCH_WINDOW", "0.01")),
+    max_inputs=int(environ.get("APIMUX_EMBED_BATCH_SIZE", "64")),
+)
+
+
+async def fetch(method: str, path: str, payload: Payload, key: str):
+    if method == "POST" and path == "embeddings" and batcher.accepts(payload.body):
+        out = await batcher.embed(payload.body)
+        result = Reply(out, "application/json", {}) if isinstance(out, bytes) else out
+    else:
+        result = await forward(method, path, payload)
+    if isinstance(result, Reply) and (ttl := cache.ttl(path)):
+        await cache.put(key, result.content, ttl)
+    return result
+
+
+@fapi.get("/metrics")
+async def metrics():
+    for h in board:
+        circuit_state.set(
+            ["closed", "half-open", "open"].index(h.state), upstream=h.name
+        )
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@fapi.api_route("/v1/{path:path}", methods=["GET", "POST"])
+async def api_v1(request: Request):
+    requests_inflight.inc()
+    try:
+        return await serve(request)
+    finally:
+        requests_inflight.dec()
+
+
+async def serve(request: Request):
+    method = request.method
+    path = request.path_params["path"]
+    payload = Payload(await request.body())
+    if isinstance(payload.body, dict) and payload.body.get("stream") is True:
+        ordered, delays = schedule("stream:" + path)
+        starts = [launcher(llm, method, path, payload, True) for llm in ordered]
+        logger.info(f"streaming {len(llms)} models")
+        result = await race("stream:" + path, starts, delays, discard=close_stream)
+        if isinstance(result, tuple):
+            requests_total.inc(path=path, result="stream")
+            resp, head, chunks = result
+            return StreamingResponse(
+                relay(resp, head, chunks),
+                media_type=resp.headers.get("content-type", "text/event-stream"),
+            )
     else:
+        key = cache.key(method, path, payload.body)
+        if cache.ttl(path) and (content := await cache.get(key)) is not None:
+            logger.info(f"cache hit {key[:8]}")
+            requests_total.inc(path=path, result="cache")
+            return Response(content, media_type="application/json")
+        coalesced = key in cache.inflight
+        result = await cache.singleflight(
+            key, lambda: fetch(method, path, payload, key)
+        )
+        if isinstance(result, Reply):
+            requests_total.inc(
+                path=path, result="coalesced" if coalesced else "upstream"
+            )
+            return Response(result.content, media_type=result.media_type)
+    if isinstance(result, Rejected):
+        requests_total.inc(path=path, result="rejected")
         return Response(
-            json.dumps(
-                {
-                    "error": {
-                        "code": "503",
-                        "message": f"all {len(llms)} llm invokes failed",
-                    }
-                }
-            ),
-            status_code=503,
+            result.content, status_code=result.status, media_type=result.media_type
         )
+    requests_total.inc(path=path, result="failed")
+    return Response(
+        orjson.dumps(
+            {
+                "error": {
+                    "code": "503",
+                    "message": f"all {len(llms)} llm invokes failed",
+                }
+            }
+        ),
+        status_code=503,
+    )
 
 
 def main():
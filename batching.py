@@ -0,0 +1,138 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from typing import Any
+from logging import getLogger
+import orjson
+
+logger = getLogger(__name__)
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.inputs: list[str] = []
+        self.waiters: list[tuple[asyncio.Future, int, int]] = []
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class EmbeddingBatcher:
+    """
+    Gathers concurrent `/embeddings` requests with the same parameters for up
+    to `window` seconds or `max_inputs` texts, sends them upstream as one
+    array `input` and splits the vectors back out to each caller. `send` takes
+    a request body and returns the upstream response bytes, or on failure
+    None or any other value describing it, which failed callers get back. If
+    a batch fails, its callers are retried one by one so a single bad input
+    cannot fail the others.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[dict], Awaitable[bytes | Any]],
+        window: float = 0.01,
+        max_inputs: int = 64,
+    ) -> None:
+        self.send = send
+        self.window = window
+        self.max_inputs = max_inputs
+        self.batches: dict[bytes, _Batch] = {}
+        self.running: set[asyncio.Task] = set()
+
+    def accepts(self, body) -> bool:
+        if self.window <= 0 or not isinstance(body, dict):
+            return False
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            return True
+        return (
+            isinstance(inputs, list)
+            and 0 < len(inputs) < self.max_inputs
+            and all(isinstance(i, str) for i in inputs)
+        )
+
+    async def embed(self, body: dict) -> bytes | Any:
+        inputs = body["input"]
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        params = {k: v for k, v in body.items() if k != "input"}
+        key = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+        batch = self.batches.get(key)
+        if batch is None or len(batch.inputs) + len(inputs) > self.max_inputs:
+            if batch is not None:
+                self._flush(key)
+            batch = self.batches[key] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(
+                self.window, self._flush, key
+            )
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.append((future, len(batch.inputs), len(inputs)))
+        batch.inputs += inputs
+        if len(batch.inputs) >= self.max_inputs:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: bytes):
+        batch = self.batches.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        params = orjson.loads(key)
+        task = asyncio.create_task(self._run(params, batch), name="embedding-batch")
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _run(self, params: dict, batch: _Batch):
+        logger.info(
+            f"embedding batch of {len(batch.inputs)} inputs from {len(batch.waiters)} requests"
+        )
+        try:
+            content = await self.send({**params, "input": batch.inputs})
+            results = (
+                self._split(content, batch) if isinstance(content, bytes) else None
+            )
+            if results is None and len(batch.waiters) > 1:
+                logger.warning("embedding batch failed, retrying requests one by one")
+                results = await asyncio.gather(
+                    *(
+                        self.send(
+                            {**params, "input": batch.inputs[start : start + count]}
+                        )
+                        for _, start, count in batch.waiters
+                    )
+                )
+            for i, (future, _, _) in enumerate(batch.waiters):
+                if not future.done():
+                    if results:
+                        future.set_result(results[i])
+                    else:
+                        future.set_result(
+                            None if isinstance(content, bytes) else content
+                        )
+        except BaseException as e:
+            for future, _, _ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+
+    @staticmethod
+    def _split(content: bytes, batch: _Batch) -> list[bytes] | None:
+        resp = orjson.loads(content)
+        data = sorted(resp.get("data") or [], key=lambda d: d.get("index", 0))
+        if len(data) != len(batch.inputs):
+            logger.error(
+                f"embedding batch got {len(data)} vectors for {len(batch.inputs)} inputs"
+            )
+            return None
+        usage = resp.get("usage") or {}
+        results = []
+        for _, start, count in batch.waiters:
+            part = [
+                {**d, "index": i} for i, d in enumerate(data[start : start + count])
+            ]
+            share = {
+                k: round(v * count / len(batch.inputs))
+                for k, v in usage.items()
+                if isinstance(v, int)
+            }
+            results.append(orjson.dumps({**resp, "data": part, "usage": share}))
+        return results
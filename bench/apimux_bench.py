@@ -0,0 +1,275 @@
+"""
+Load test apimux (or ChatMux) against local fake upstreams.
+
+    python -m bench.apimux_bench --requests 200 --concurrency 16 --strategies race,hedge
+    python -m bench.apimux_bench --stream --upstream median=0.3,error_rate=0.2 --upstream median=1
+    python -m bench.apimux_bench --target chatmux
+
+Each strategy runs a fresh apimux process with the matching environment. The
+report shows throughput, p50/p99 latency (time to first byte for streams),
+failures, and upstream calls per request, where every call beyond the one
+that answered is counted as wasted.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from pathlib import Path
+from time import monotonic
+import httpx
+
+ROOT = Path(__file__).resolve().parents[1]
+
+STRATEGIES = {
+    "race": {"APIMUX_HEDGE": "0"},
+    "hedge": {"APIMUX_HEDGE": "1", "APIMUX_HEDGE_PERCENTILE": "0.9"},
+    "hedge-p50": {"APIMUX_HEDGE": "1", "APIMUX_HEDGE_PERCENTILE": "0.5"},
+}
+
+DEFAULT_UPSTREAMS = [
+    "name=fast-flaky,median=0.3,sigma=0.3,error_rate=0.1",
+    "name=steady,median=0.6,sigma=0.2",
+    "name=slow-tail,median=0.5,sigma=1.0",
+]
+
+
+def parse_upstream(spec: str) -> dict[str, str]:
+    return dict(item.split("=", 1) for item in spec.split(",") if item)
+
+
+async def spawn(*args: str, env: dict[str, str] | None = None):
+    return await asyncio.create_subprocess_exec(
+        sys.executable,
+        *args,
+        cwd=ROOT,
+        env={**os.environ, **(env or {})},
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, url: str, timeout: float = 20):
+    until = monotonic() + timeout
+    while monotonic() < until:
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up")
+
+
+async def start_fakes(specs: list[str], base_port: int):
+    procs = []
+    urls = []
+    for i, spec in enumerate(specs):
+        opts = parse_upstream(spec)
+        port = base_port + i
+        args = ["-m", "bench.fakeupstream", "--port", str(port)]
+        args += ["--name", opts.pop("name", f"fake{i + 1}")]
+        for k, v in opts.items():
+            args += ["--" + k.replace("_", "-"), v]
+        procs.append(await spawn(*args))
+        urls.append(f"http://127.0.0.1:{port}")
+    return procs, urls
+
+
+def mux_env(urls: list[str], strategy: str) -> dict[str, str]:
+    env = {
+        # keep real upstreams and caching from .env out of the benchmark
+        **{f"LLM{i}_MODEL": "" for i in range(1, 100)},
+        "APIMUX_CACHE_TTL": "",
+        "APIMUX_CACHE_DIR": "",
+        **STRATEGIES[strategy],
+    }
+    for i, url in enumerate(urls, 1):
+        env[f"LLM{i}_MODEL"] = f"fake{i}"
+        env[f"LLM{i}_API_KEY"] = "bench"
+        env[f"LLM{i}_BASE_URL"] = url + "/v1"
+    return env
+
+
+def body(tag: str, stream: bool) -> dict:
+    # distinct bodies, so apimux does not coalesce concurrent requests
+    return {
+        "model": "apimux",
+        "stream": stream,
+        "messages": [{"role": "user", "content": f"benchmark request {tag}"}],
+    }
+
+
+async def one(client: httpx.AsyncClient, url: str, tag: str, stream: bool):
+    started = monotonic()
+    try:
+        if stream:
+            async with client.stream("POST", url, json=body(tag, stream)) as resp:
+                ttfb = None
+                async for _ in resp.aiter_bytes():
+                    if ttfb is None:
+                        ttfb = monotonic() - started
+                ok = resp.status_code == 200
+                return ok, ttfb if ttfb is not None else monotonic() - started
+        resp = await client.post(url, json=body(tag, stream))
+        return resp.status_code == 200, monotonic() - started
+    except httpx.HTTPError:
+        return False, monotonic() - started
+
+
+async def load(send, requests: int, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def run(i: int):
+        async with sem:
+            return await send(i)
+
+    started = monotonic()
+    results = await asyncio.gather(*(run(i) for i in range(requests)))
+    return results, monotonic() - started
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def upstream_calls(client: httpx.AsyncClient, urls: list[str], reset=False):
+    calls = 0
+    for url in urls:
+        if reset:
+            await client.post(url + "/reset")
+        else:
+            calls += (await client.get(url + "/stats")).json()["started"]
+    return calls
+
+
+def report(name: str, results, elapsed: float, calls: int):
+    ok = [latency for success, latency in results if success]
+    wasted = calls - len(ok)
+    print(
+        f"{name:<12} {len(ok) / elapsed:8.2f} {percentile(ok, 0.5):8.3f} "
+        f"{percentile(ok, 0.99):8.3f} {len(results) - len(ok):7d} "
+        f"{calls / len(results):10.2f} {wasted:7d}"
+    )
+
+
+def print_header(stream: bool):
+    latency = "ttfb" if stream else "lat"
+    print(
+        f"{'strategy':<12} {'req/s':>8} {'p50' + latency:>8} {'p99' + latency:>8} "
+        f"{'failed':>7} {'calls/req':>10} {'wasted':>7}"
+    )
+
+
+async def bench_apimux(args, client: httpx.AsyncClient, urls: list[str]):
+    mux_url = f"http://127.0.0.1:{args.port}"
+    for strategy in args.strategies.split(","):
+        mux = await spawn(
+            "apimux.py",
+            "127.0.0.1",
+            str(args.port),
+            env=mux_env(urls, strategy),
+        )
+        try:
+            await wait_ready(client, mux_url + "/metrics")
+            if args.warmup:
+                await load(
+                    lambda i: one(
+                        client, mux_url + "/v1/chat/completions", f"w{i}", args.stream
+                    ),
+                    args.warmup,
+                    args.concurrency,
+                )
+            await upstream_calls(client, urls, reset=True)
+            results, elapsed = await load(
+                lambda i: one(
+                    client, mux_url + "/v1/chat/completions", str(i), args.stream
+                ),
+                args.requests,
+                args.concurrency,
+            )
+            report(strategy, results, elapsed, await upstream_calls(client, urls))
+        finally:
+            mux.terminate()
+            await mux.wait()
+
+
+async def bench_chatmux(args, client: httpx.AsyncClient, urls: list[str]):
+    for k in ("Q_USR", "Q_NICK", "Q_GRP", "Q_CON", "DATADIR"):
+        os.environ.setdefault(k, "0")
+    os.environ.setdefault("TZ", "UTC")
+    sys.path.insert(0, str(ROOT))
+    from langchain_core.messages import HumanMessage
+    from langchain_openai import ChatOpenAI
+    from adapt import ChatMux
+
+    mux = ChatMux(
+        [
+            ChatOpenAI(
+                model=f"fake{i}",
+                api_key="bench",  # type: ignore
+                base_url=url + "/v1",
+                max_retries=0,
+            )
+            for i, url in enumerate(urls, 1)
+        ]
+    )
+
+    async def send(i: int):
+        started = monotonic()
+        try:
+            await mux.ainvoke([HumanMessage(f"benchmark request {i}")])
+            return True, monotonic() - started
+        except Exception:
+            return False, monotonic() - started
+
+    await upstream_calls(client, urls, reset=True)
+    results, elapsed = await load(send, args.requests, args.concurrency)
+    report("chatmux", results, elapsed, await upstream_calls(client, urls))
+
+
+async def amain():
+    parser = argparse.ArgumentParser(description="apimux load test")
+    parser.add_argument("--target", choices=["apimux", "chatmux"], default="apimux")
+    parser.add_argument(
+        "--upstream",
+        action="append",
+        help="fake upstream as key=value,... of name, median, sigma, error_rate, "
+        "error_status, chunks, chunk_interval; repeatable",
+    )
+    parser.add_argument("--strategies", default=",".join(STRATEGIES))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=40)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--port", type=int, default=18400)
+    parser.add_argument("--upstream-port", type=int, default=18401)
+    args = parser.parse_args()
+
+    fakes, urls = await start_fakes(
+        args.upstream or DEFAULT_UPSTREAMS, args.upstream_port
+    )
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    try:
+        async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+            for url in urls:
+                await wait_ready(client, url + "/stats")
+            print_header(args.stream)
+            if args.target == "apimux":
+                await bench_apimux(args, client, urls)
+            else:
+                await bench_chatmux(args, client, urls)
+    finally:
+        for fake in fakes:
+            fake.terminate()
+        await asyncio.gather(*(fake.wait() for fake in fakes))
+
+
+def main():
+    asyncio.run(amain())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Fake OpenAI-compatible upstream for benchmarking apimux and ChatMux without
+paid providers.
+
+    python -m bench.fakeupstream --port 18001 --median 0.8 --sigma 0.5 --error-rate 0.05
+
+Latency is log-normal around `--median`. Streams wait that long before the
+first delta, then emit `--chunks` deltas `--chunk-interval` apart. `GET /stats`
+reports how many requests were started, finished and failed, and `POST /reset`
+clears the counters.
+"""
+
+import argparse
+import asyncio
+import math
+import random
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import orjson
+import uvicorn
+
+
+def make_app(
+    name: str = "fake",
+    median: float = 0.5,
+    sigma: float = 0.3,
+    error_rate: float = 0.0,
+    error_status: int = 500,
+    chunks: int = 20,
+    chunk_interval: float = 0.02,
+    dimensions: int = 8,
+) -> FastAPI:
+    app = FastAPI()
+    stats = {"started": 0, "finished": 0, "failed": 0}
+
+    def latency() -> float:
+        return random.lognormvariate(math.log(median), sigma)
+
+    def usage(body: dict, completion: int) -> dict:
+        prompt = len(orjson.dumps(body.get("messages") or body.get("input"))) // 4
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+        }
+
+    def error() -> Response:
+        stats["failed"] += 1
+        return JSONResponse(
+            {"error": {"code": str(error_status), "message": f"{name} failed"}},
+            status_code=error_status,
+        )
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        stats["started"] += 1
+        body = orjson.loads(await request.body())
+        if random.random() < error_rate:
+            await asyncio.sleep(latency() / 4)
+            return error()
+        if body.get("stream"):
+
+            async def events():
+                await asyncio.sleep(latency())
+                for i in range(chunks):
+                    chunk = {
+                        "model": body.get("model"),
+                        "choices": [{"index": 0, "delta": {"content": f"{name}{i} "}}],
+                    }
+                    yield b"data: " + orjson.dumps(chunk) + b"\n\n"
+                    await asyncio.sleep(chunk_interval)
+                yield b"data: [DONE]\n\n"
+                stats["finished"] += 1
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+        await asyncio.sleep(latency() + chunks * chunk_interval)
+        stats["finished"] += 1
+        return {
+            "id": f"{name}-{stats['started']}",
+            "object": "chat.completion",
+            "model": body.get("model"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": f"{name} says hi"},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage(body, chunks),
+        }
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        stats["started"] += 1
+        body = orjson.loads(await request.body())
+        if random.random() < error_rate:
+            await asyncio.sleep(latency() / 4)
+            return error()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(latency())
+        stats["finished"] += 1
+        return {
+            "object": "list",
+            "model": body.get("model"),
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": [
+                        random.Random(f"{text}:{d}").uniform(-1, 1)
+                        for d in range(body.get("dimensions") or dimensions)
+                    ],
+                }
+                for i, text in enumerate(inputs)
+            ],
+            "usage": usage(body, 0),
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/reset")
+    async def reset():
+        for k in stats:
+            stats[k] = 0
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake OpenAI-compatible upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18001)
+    parser.add_argument("--name", default="fake")
+    parser.add_argument("--median", type=float, default=0.5)
+    parser.add_argument("--sigma", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--chunk-interval", type=float, default=0.02)
+    args = parser.parse_args()
+    app = make_app(
+        args.name,
+        args.median,
+        args.sigma,
+        args.error_rate,
+        args.error_status,
+        args.chunks,
+        args.chunk_interval,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Compare memory vector store layouts on synthetic clustered unit vectors:
+Chroma, the SQLite-backed QuantizedVectorStore (float16, int8) and the
+memory-mapped MmapVectorStore (mmap, mmap-float16, mmap-int8).
+
+    python -m bench.vecstore_bench --count 10000
+    python -m bench.vecstore_bench --count 1000000 --layouts mmap,mmap-int8
+
+Each layout is built in this process, then reopened in a fresh process that
+reports startup time (open plus first query), search latency, recall@k
+against exact float32 search, and the resident memory it added. Vectors are
+generated in batches, so large counts need only the store's own memory.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import monotonic
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+from vecstore import MmapVectorStore, QuantizedVectorStore, normalize
+
+LAYOUTS = ["chroma", "float16", "int8", "mmap", "mmap-float16", "mmap-int8"]
+
+
+class TableEmbeddings(Embeddings):
+    """Looks texts up in a table of precomputed vectors, so embedding is free."""
+
+    def __init__(self, table: dict[str, np.ndarray] | None = None) -> None:
+        self.table = table or {}
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.table[t].tolist() for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.table[text].tolist()
+
+
+def centers(count: int, dimensions: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((min(max(count // 100, 1), 10000), dimensions))
+
+
+def clustered(rng, middles: np.ndarray, n: int) -> np.ndarray:
+    points = middles[rng.integers(len(middles), size=n)]
+    return normalize(points + 0.5 * rng.standard_normal(points.shape))
+
+
+def batches(count: int, dimensions: int, size: int, seed: int = 0):
+    middles = centers(count, dimensions, seed)
+    for start in range(0, count, size):
+        rng = np.random.default_rng([seed, start])
+        yield clustered(rng, middles, min(size, count - start))
+
+
+def query_vectors(count: int, dimensions: int, queries: int, seed: int = 0):
+    rng = np.random.default_rng([seed, count + 1])
+    return clustered(rng, centers(count, dimensions, seed), queries)
+
+
+def exact_top(args, queries: np.ndarray) -> np.ndarray:
+    """Row numbers of the `k` documents closest to each query."""
+    best = np.empty((len(queries), 0), dtype=np.int64)
+    scores = np.empty((len(queries), 0), dtype=np.float32)
+    start = 0
+    for batch in batches(args.count, args.dimensions, args.batch):
+        rows = np.arange(start, start + len(batch))
+        scores = np.concatenate([scores, queries @ batch.T], axis=1)
+        best = np.concatenate([best, np.tile(rows, (len(queries), 1))], axis=1)
+        keep = np.argsort(-scores, axis=1)[:, : args.k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        best = np.take_along_axis(best, keep, axis=1)
+        start += len(batch)
+    return best
+
+
+def open_store(layout: str, directory: str, embeddings: Embeddings):
+    if layout == "chroma":
+        from langchain_chroma import Chroma
+
+        return Chroma(
+            "bench", embedding_function=embeddings, persist_directory=directory
+        )
+    if layout.startswith("mmap"):
+        mode = layout.partition("-")[2] or "float32"
+        return MmapVectorStore("bench", embeddings, directory, mode)
+    return QuantizedVectorStore("bench", embeddings, directory, layout)
+
+
+def rss() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def disk_bytes(directory: str) -> int:
+    return sum(p.stat().st_size for p in Path(directory).rglob("*") if p.is_file())
+
+
+def build(layout: str, args, directory: str) -> float:
+    """Fill a fresh store, returning inserts per second."""
+    embeddings = TableEmbeddings()
+    store = open_store(layout, directory, embeddings)
+    started = monotonic()
+    start = 0
+    for batch in batches(args.count, args.dimensions, args.batch):
+        texts = [f"doc {i}" for i in range(start, start + len(batch))]
+        embeddings.table = dict(zip(texts, batch))
+        store.add_texts(texts, ids=texts)
+        start += len(batch)
+    elapsed = monotonic() - started
+    if hasattr(store, "close"):
+        store.close()
+    return args.count / elapsed
+
+
+def probe(layout: str, directory: str, k: int):
+    """Reopen a built store in this fresh process and print its stats as JSON."""
+    if layout == "chroma":
+        # keep the import cost out of the RSS delta
+        import langchain_chroma  # noqa: F401
+    queries = np.load(Path(directory) / "queries.npy")
+    truth = np.load(Path(directory) / "truth.npy")
+    before = rss()
+    started = monotonic()
+    store = open_store(layout, str(Path(directory) / "store"), TableEmbeddings())
+    store.similarity_search_by_vector(queries[0].tolist(), k=k)
+    startup = monotonic() - started
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        started = monotonic()
+        found = store.similarity_search_by_vector(query.tolist(), k=k)
+        latencies.append(monotonic() - started)
+        hits += len({d.id for d in found} & {f"doc {i}" for i in expected})
+    stats = {
+        "startup": startup,
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+        "recall": hits / truth.size,
+        "rss": rss() - before,
+    }
+    print(json.dumps(stats))
+
+
+def run(layout: str, args, queries: np.ndarray, truth: np.ndarray):
+    with tempfile.TemporaryDirectory() as directory:
+        np.save(Path(directory) / "queries.npy", queries)
+        np.save(Path(directory) / "truth.npy", truth)
+        insert = build(layout, args, directory + "/store")
+        out = subprocess.run(
+            [sys.executable, "-m", "bench.vecstore_bench", "--k", str(args.k)]
+            + ["--probe", layout, directory],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        stats = json.loads(out.strip().splitlines()[-1])
+        print(
+            f"{layout:<13} {insert:9.0f} {stats['startup']:8.2f} "
+            f"{stats['p50'] * 1000:8.2f} {stats['p99'] * 1000:8.2f} "
+            f"{stats['recall']:7.3f} {disk_bytes(directory + '/store') / 2**20:8.1f} "
+            f"{stats['rss'] / 2**20:8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="memory vector store benchmark")
+    parser.add_argument("--layouts", default=",".join(LAYOUTS))
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--probe", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.probe:
+        probe(*args.probe, args.k)
+        return
+
+    queries = query_vectors(args.count, args.dimensions, args.queries)
+    truth = exact_top(args, queries)
+    print(
+        f"{'layout':<13} {'insert/s':>9} {'startup':>8} {'p50 ms':>8} {'p99 ms':>8} "
+        f"{'recall':>7} {'disk MB':>8} {'rss MB':>8}"
+    )
+    for layout in args.layouts.split(","):
+        run(layout, args, queries, truth)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+from collections.abc import Coroutine
+from concurrent.futures import Future
+from logging import getLogger
+from typing import Any, TypeVar
+
+logger = getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class BackgroundLoop:
+    """
+    An event loop running forever in a daemon thread, for running coroutines
+    from synchronous code, including code that is itself called from inside
+    another running loop where `asyncio.run` would fail. Clients created by
+    coroutines on this loop stay bound to it and are reused across calls.
+    """
+
+    def __init__(self, name: str = "background-loop") -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=loop.run_forever, name=self.name, daemon=True
+                )
+                self.thread.start()
+                self.loop = loop
+                logger.info(f"started {self.name}")
+            return self.loop
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+        return asyncio.run_coroutine_threadsafe(coro, self._start())
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Run `coro` on the background loop and block until it finishes."""
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError(f"blocking call from inside {self.name}")
+        return self.submit(coro).result()
+
+
+background = BackgroundLoop()
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    return background.run(coro)
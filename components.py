@@ -1,10 +1,13 @@
 import asyncio
+import os
 from langchain_openai import ChatOpenAI
 from langchain_chroma import Chroma
 from langchain_core.language_models import BaseChatModel
 from langchain_core.rate_limiters import InMemoryRateLimiter
 from config import *
-from adapt import GiteeAIEmbeddings, ChatMux
+from adapt import CachedEmbeddingModel, GiteeAIEmbeddings, ChatMux
+from embcache import EmbeddingCache
+from vecstore import MmapVectorStore, QuantizedVectorStore
 from langfuse import get_client
 from pydantic_ai.models.openai import OpenAIChatModel
 from pydantic_ai.embeddings.openai import OpenAIEmbeddingModel
@@ -27,7 +30,12 @@ embed_model = OpenAIEmbeddingModel(
     settings={"dimensions": int(ENV["EMBED_DIMENSIONS"])},
 )
 
-embedder = Embedder(embed_model)
+embed_cache = EmbeddingCache(
+    DATADIR + "/embeddings.sqlite3",
+    max_entries=int(ENV.get("EMBED_CACHE_SIZE", "200000")),
+)
+
+embedder = Embedder(CachedEmbeddingModel(embed_model, embed_cache))
 
 llm = ChatOpenAI(
     rate_limiter=InMemoryRateLimiter(requests_per_second=1),
@@ -43,14 +51,44 @@ embed = GiteeAIEmbeddings(
     model=ENV["EMBED_MODEL"],
     base_url=ENV["EMBED_BASE_URL"],
     api_key=ENV["EMBED_API_KEY"],  # type: ignore
+    batch_size=int(ENV.get("EMBED_BATCH_SIZE", "32")),
+    concurrency=int(ENV.get("EMBED_CONCURRENCY", "4")),
+    cache=embed_cache,
 )
 
 langfuse = get_client()
 
 
-def make_chroma(col: str, persist_dir: str | None = None):
-    # embed = OpenAIEmbeddings(
-    return Chroma(col, embedding_function=embed, persist_directory=persist_dir)
+def make_chroma(
+    col: str,
+    persist_dir: str | None = None,
+    quantize: str | None = None,
+    backend: str = "chroma",
+):
+    """
+    Vector store for collection `col`: Chroma by default. `backend="mmap"`
+    selects a `MmapVectorStore` holding `quantize` codes (float32 if unset);
+    otherwise `quantize` set to "float16" or "int8" selects a
+    `QuantizedVectorStore`. Either is seeded from the Chroma collection on
+    first use.
+    """
+    if backend == "mmap":
+        store = MmapVectorStore(col, embed, persist_dir, quantize or "float32")
+    elif backend != "chroma":
+        raise ValueError(f"unknown vector store backend {backend!r}")
+    elif quantize:
+        store = QuantizedVectorStore(col, embed, persist_dir, quantize)
+    else:
+        # embed = OpenAIEmbeddings(
+        return Chroma(col, embedding_function=embed, persist_directory=persist_dir)
+    # the stores create persist_dir themselves, so look for Chroma's own file
+    # rather than open (and create) a Chroma database with nothing to import
+    chroma_db = os.path.join(persist_dir or "", "chroma.sqlite3")
+    if store.count == 0 and persist_dir and os.path.isfile(chroma_db):
+        store.import_from(
+            Chroma(col, embedding_function=embed, persist_directory=persist_dir)
+        )
+    return store
     # from chromadb import Documents, Embeddings, EmbeddingFunction
     # import numpy as np
 
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from collections.abc import Sequence
+from logging import getLogger
+from time import time
+
+logger = getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Embedding vectors persisted in SQLite, keyed by a hash of (model,
+    dimensions, text) and stored as float32 blobs. Holds at most
+    `max_entries` vectors; beyond that the least recently used tenth is
+    evicted. Safe to share between threads and event loops.
+    """
+
+    BATCH = 500
+
+    def __init__(self, path: str, max_entries: int = 200_000) -> None:
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS vectors"
+            " (key BLOB PRIMARY KEY, vec BLOB NOT NULL, atime REAL NOT NULL)"
+            " WITHOUT ROWID"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS vectors_atime ON vectors (atime)")
+        self.count = self.db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    @staticmethod
+    def key(model: str, dimensions: int | None, text: str) -> bytes:
+        return hashlib.sha256(f"{model}\0{dimensions}\0{text}".encode()).digest()
+
+    def get(
+        self, model: str, dimensions: int | None, texts: Sequence[str]
+    ) -> dict[str, list[float]]:
+        keys = {self.key(model, dimensions, t): t for t in texts}
+        found = {}
+        with self.lock:
+            items = list(keys)
+            for i in range(0, len(items), self.BATCH):
+                chunk = items[i : i + self.BATCH]
+                rows = self.db.execute(
+                    "SELECT key, vec FROM vectors WHERE key IN"
+                    f" ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for key, vec in rows:
+                    found[keys[key]] = array("f", vec).tolist()
+                if rows:
+                    now = time()
+                    self.db.executemany(
+                        "UPDATE vectors SET atime = ? WHERE key = ?",
+                        [(now, key) for key, _ in rows],
+                    )
+        return found
+
+    def put(
+        self, model: str, dimensions: int | None, vectors: dict[str, Sequence[float]]
+    ):
+        if not vectors:
+            return
+        now = time()
+        rows = [
+            (self.key(model, dimensions, t), array("f", v).tobytes(), now)
+            for t, v in vectors.items()
+        ]
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for row in rows:
+                    cur = self.db.execute(
+                        "INSERT OR IGNORE INTO vectors VALUES (?, ?, ?)", row
+                    )
+                    self.count += cur.rowcount
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            if self.count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        keep = self.max_entries * 9 // 10
+        self.db.execute(
+            "DELETE FROM vectors WHERE key IN"
+            " (SELECT key FROM vectors ORDER BY atime LIMIT ?)",
+            (self.count - keep,),
+        )
+        self.count = self.db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        logger.info(f"embedding cache evicted down to {self.count} entries")
+
+    async def aget(
+        self, model: str, dimensions: int | None, texts: Sequence[str]
+    ) -> dict[str, list[float]]:
+        return await asyncio.to_thread(self.get, model, dimensions, texts)
+
+    async def aput(
+        self, model: str, dimensions: int | None, vectors: dict[str, Sequence[float]]
+    ):
+        await asyncio.to_thread(self.put, model, dimensions, vectors)
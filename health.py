@@ -0,0 +1,213 @@
+import asyncio
+from collections import deque
+from logging import getLogger
+from time import monotonic
+from typing import Literal
+
+logger = getLogger(__name__)
+
+CircuitState = Literal["closed", "open", "half-open"]
+
+
+def is_upstream_fault(status: int) -> bool:
+    """Rate limits and server errors count against an upstream, other 4xx do not."""
+    return status == 429 or status >= 500
+
+
+class Latency:
+    """EWMA and sliding window of successful response latencies."""
+
+    def __init__(self, alpha: float = 0.2, window: int = 200) -> None:
+        self.alpha = alpha
+        self.ewma: float | None = None
+        self.samples: deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        if self.ewma is None:
+            self.ewma = seconds
+        else:
+            self.ewma += self.alpha * (seconds - self.ewma)
+
+    def percentile(self, q: float, min_samples: int = 1) -> float | None:
+        if len(self.samples) < max(1, min_samples):
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Health:
+    """
+    Health of one upstream: EWMA latency per request kind, EWMA error rate
+    and a circuit breaker. The circuit opens after `failures` consecutive
+    faults, or when the error rate exceeds `error_rate` once that many calls
+    have been seen. After `cooldown` seconds it goes half-open and lets a
+    single probe through; the probe closes it again or reopens it with a
+    doubled cooldown.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        alpha: float = 0.2,
+        failures: int = 3,
+        error_rate: float = 0.5,
+        cooldown: float = 30,
+        max_cooldown: float = 600,
+    ) -> None:
+        self.name = name
+        self.alpha = alpha
+        self.failure_threshold = failures
+        self.error_rate_threshold = error_rate
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.latencies: dict[str, Latency] = {}
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.state: CircuitState = "closed"
+        self.cooldown = cooldown
+        self.opened_at = 0.0
+        self.probing = False
+
+    def latency(self, kind: str = "") -> Latency:
+        if kind not in self.latencies:
+            self.latencies[kind] = Latency(self.alpha)
+        return self.latencies[kind]
+
+    def available(self) -> bool:
+        if self.state == "open" and monotonic() - self.opened_at >= self.cooldown:
+            logger.info(f"circuit {self.name} half-open")
+            self.state = "half-open"
+        if self.state == "half-open":
+            return not self.probing
+        return self.state == "closed"
+
+    def score(self, kind: str = "") -> float:
+        """Expected seconds to a successful response, lower is better."""
+        latency = self.latency(kind).ewma or 0
+        return latency / max(0.05, 1 - self.error_rate)
+
+    def attempt(self, kind: str = "") -> "Attempt":
+        probe = self.state == "half-open"
+        if probe:
+            self.probing = True
+        return Attempt(self, kind, probe)
+
+    def claim(self, kind: str = "") -> "Attempt | None":
+        """
+        An attempt started now, or None if the circuit is half-open and its
+        probe is already out. Claim right before the call, not when ranking:
+        the circuit may have gone half-open, or been probed, in between.
+        """
+        self.available()
+        if self.state == "half-open" and self.probing:
+            return None
+        return self.attempt(kind)
+
+    def _record(self, failed: bool):
+        self.calls += 1
+        self.error_rate += self.alpha * (float(failed) - self.error_rate)
+        self.probing = False
+
+    def _success(self, seconds: float, kind: str):
+        self._record(False)
+        self.latency(kind).add(seconds)
+        self.failures = 0
+        if self.state != "closed":
+            logger.info(f"circuit {self.name} closed")
+            self.state = "closed"
+            self.cooldown = self.base_cooldown
+
+    def _failure(self):
+        self._record(True)
+        self.failures += 1
+        if self.state == "half-open":
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self._open()
+        elif self.state == "closed" and (
+            self.failures >= self.failure_threshold
+            or (
+                self.calls >= self.failure_threshold
+                and self.error_rate > self.error_rate_threshold
+            )
+        ):
+            self._open()
+
+    def _release(self):
+        self.probing = False
+
+    def _open(self):
+        logger.warning(
+            f"circuit {self.name} open for {self.cooldown}s, error rate {self.error_rate:.2f}"
+        )
+        self.state = "open"
+        self.opened_at = monotonic()
+
+
+class Attempt:
+    """
+    One call to an upstream. Report the outcome with `success` or `failure`;
+    an exception leaving the `with` block is a failure unless it carries a
+    non-fault `status_code`, and an unreported or cancelled attempt is neutral.
+    """
+
+    def __init__(self, health: Health, kind: str, probe: bool = False) -> None:
+        self.health = health
+        self.kind = kind
+        self.probe = probe
+        self.started = monotonic()
+        self.reported = False
+
+    def success(self):
+        if not self.reported:
+            self.reported = True
+            self.health._success(monotonic() - self.started, self.kind)
+
+    def failure(self):
+        if not self.reported:
+            self.reported = True
+            self.health._failure()
+
+    def release(self):
+        """End the attempt without an outcome, freeing the probe if it was one."""
+        if not self.reported:
+            self.reported = True
+            if self.probe:
+                self.health._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            status = getattr(exc, "status_code", None)
+            if not isinstance(status, int) or is_upstream_fault(status):
+                self.failure()
+        self.release()
+        return False
+
+
+class HealthBoard:
+    """Health of a set of upstreams, shared by the calls racing them."""
+
+    def __init__(self, **kwargs) -> None:
+        self.kwargs = kwargs
+        self._health: dict[str, Health] = {}
+
+    def __getitem__(self, name: str) -> Health:
+        if name not in self._health:
+            self._health[name] = Health(name, **self.kwargs)
+        return self._health[name]
+
+    def __iter__(self):
+        return iter(list(self._health.values()))
+
+    def rank(self, items: list, name, kind: str = "") -> list:
+        """
+        Available `items` ordered best first, `name(item)` naming each. When
+        every circuit is open, all items are returned so callers still try.
+        """
+        ordered = sorted(items, key=lambda item: self[name(item)].score(kind))
+        available = [item for item in ordered if self[name(item)].available()]
+        return available or ordered
@@ -11,6 +11,7 @@ from pydantic_graph import End
 from pydantic_graph.persistence.file import FileStatePersistence
 
 from agenting.graph import Idle, graph
+from agenting.memqueue import memory_queue
 from agenting.tools import local_toolset
 from agenting.types import BotDeps, BotState
 from config import *
@@ -83,12 +84,20 @@ async def amain():
         CombinedToolset[BotDeps]([oicq_toolset, local_toolset] + servers), ""
     )
 
-    async with graph.iter(node, state=state, deps=deps, persistence=persist) as run:
-        while True:
-            node = await run.next()
-            if isinstance(node, End):
-                break
-            logger.info(node)
+    memory_queue.start()
+    try:
+        # keep MCP sessions open, so their tool lists stay cached between steps
+        async with (
+            deps.toolset,
+            graph.iter(node, state=state, deps=deps, persistence=persist) as run,
+        ):
+            while True:
+                node = await run.next()
+                if isinstance(node, End):
+                    break
+                logger.info(node)
+    finally:
+        await memory_queue.stop()
 
 
 def main():
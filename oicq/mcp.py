@@ -13,6 +13,8 @@ from ncatbot.core.event import GroupMessageEvent, PrivateMessageEvent
 from asyncio_channel import create_channel, create_sliding_buffer
 from .cqface import CQFACE
 from sys import argv
+from functools import cache
+from promptcache import CachedPrompt
 from .globl import mcp, port, qbot, langfuse
 from .events import wait_events
 from .status import init_read_status, get_status
@@ -45,9 +47,16 @@ INSTRUCTIONS = f"""
 """
 
 
+add_prompts = CachedPrompt(langfuse, "oicq-add", float(ENV.get("PROMPT_TTL", "300")))
+
+
+@cache
+def render_instructions(add: str) -> str:
+    return INSTRUCTIONS.format(add_prompts=add)
+
+
 async def get_instructions():
-    add_prompts = langfuse.get_prompt("oicq-add")
-    return INSTRUCTIONS.format(add_prompts=add_prompts.prompt)
+    return render_instructions(add_prompts.get())
 
 
 @mcp.prompt()
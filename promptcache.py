@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+from logging import getLogger
+from time import time
+from typing import Any
+
+logger = getLogger(__name__)
+
+
+class CachedPrompt:
+    """
+    Text of a langfuse prompt served from memory. Once `ttl` seconds old it is
+    refetched in a background thread while the old text keeps being served,
+    and if langfuse is down the last text fetched stays in use. Only the
+    first `get` waits for langfuse.
+    """
+
+    RETRY = 30
+
+    def __init__(self, langfuse, name: str, ttl: float = 300) -> None:
+        self.langfuse = langfuse
+        self.name = name
+        self.ttl = ttl
+        self.text: str | None = None
+        self.expires = 0.0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def get(self) -> str:
+        if self.text is None:
+            self._refresh()
+        elif time() >= self.expires:
+            with self.lock:
+                start = not self.refreshing
+                self.refreshing = True
+            if start:
+                threading.Thread(
+                    target=self._refresh, name=f"prompt-{self.name}", daemon=True
+                ).start()
+        assert self.text is not None
+        return self.text
+
+    def _refresh(self):
+        try:
+            # bypass the SDK's own cache, which this replaces
+            text = self.langfuse.get_prompt(self.name, cache_ttl_seconds=0).prompt
+            self.text = text
+            self.expires = time() + self.ttl
+        except Exception as e:
+            if self.text is None:
+                raise
+            logger.warning(f"langfuse prompt {self.name} refresh failed: {e}")
+            self.expires = time() + self.RETRY
+        finally:
+            self.refreshing = False
+
+
+class NoteFile:
+    """
+    A JSON list on disk, parsed again only when the file's mtime or size
+    changes; writes through `save` update the parsed copy directly.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.stat: tuple[int, int] | None = None
+        self.items: list[Any] = []
+
+    def _stat(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self) -> list[Any]:
+        """A copy of the list; empty if the file is missing or not a list."""
+        stat = self._stat()
+        if stat != self.stat:
+            try:
+                with open(self.path, "r") as f:
+                    items = json.load(f)
+            except (json.JSONDecodeError, FileNotFoundError):
+                items = []
+            self.items = items if isinstance(items, list) else []
+            self.stat = stat
+        return list(self.items)
+
+    def save(self, items: list[Any]):
+        with open(self.path, "w") as f:
+            json.dump(items, f, ensure_ascii=False, indent=2)
+        self.items = list(items)
+        self.stat = self._stat()
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import os
+from collections.abc import Awaitable, Callable
+from logging import getLogger
+from pathlib import Path
+from time import time
+from lru import LRU
+import orjson
+
+logger = getLogger(__name__)
+
+
+def parse_ttls(spec: str) -> dict[str, float]:
+    """Parse `path=seconds,path=seconds` into a TTL table."""
+    ttls = {}
+    for item in spec.split(","):
+        if "=" in item:
+            path, ttl = item.split("=", 1)
+            ttls[path.strip().strip("/")] = float(ttl)
+    return ttls
+
+
+class ResponseCache:
+    """
+    Raw upstream response bytes keyed by the normalized request, in an LRU
+    memory tier backed by an optional on-disk tier. Concurrent fetches of the
+    same key are coalesced into one.
+    """
+
+    def __init__(
+        self, ttls: dict[str, float], size: int = 1024, directory: str | None = None
+    ) -> None:
+        self.ttls = ttls
+        self.memory = LRU(size)
+        self.directory = Path(directory) if directory else None
+        self.inflight: dict[str, asyncio.Task] = {}
+
+    def ttl(self, path: str) -> float:
+        return self.ttls.get(path.strip("/"), 0)
+
+    @staticmethod
+    def key(method: str, path: str, body) -> str:
+        normalized = orjson.dumps(
+            [method, path.strip("/"), body], option=orjson.OPT_SORT_KEYS
+        )
+        return hashlib.sha256(normalized).hexdigest()
+
+    def _file(self, key: str) -> Path:
+        assert self.directory is not None
+        return self.directory / key[:2] / f"{key}.bin"
+
+    def _read(self, key: str) -> tuple[float, bytes] | None:
+        # entry file: expiry timestamp line, then the response bytes
+        try:
+            with open(self._file(key), "rb") as f:
+                expires = float(f.readline())
+                value = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        if expires <= time():
+            self._file(key).unlink(missing_ok=True)
+            return None
+        return expires, value
+
+    def _write(self, key: str, expires: float, value: bytes):
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(b"%f\n" % expires)
+            f.write(value)
+        os.replace(tmp, file)
+
+    def prune(self):
+        """Remove expired entries from the disk tier."""
+        if self.directory is None or not self.directory.exists():
+            return
+        removed = 0
+        for file in self.directory.glob("*/*.bin"):
+            try:
+                with open(file, "rb") as f:
+                    expired = float(f.readline()) <= time()
+            except (OSError, ValueError):
+                expired = True
+            if expired:
+                file.unlink(missing_ok=True)
+                removed += 1
+        logger.info(f"response cache pruned {removed} entries")
+
+    async def get(self, key: str) -> bytes | None:
+        if entry := self.memory.get(key):
+            if entry[0] > time():
+                return entry[1]
+            del self.memory[key]
+        if self.directory is None:
+            return None
+        if entry := await asyncio.to_thread(self._read, key):
+            self.memory[key] = entry
+            return entry[1]
+        return None
+
+    async def put(self, key: str, value: bytes, ttl: float):
+        expires = time() + ttl
+        self.memory[key] = (expires, value)
+        if self.directory is not None:
+            try:
+                await asyncio.to_thread(self._write, key, expires, value)
+            except OSError as e:
+                logger.error(f"response cache write error: {e}")
+
+    async def singleflight(self, key: str, fetch: Callable[[], Awaitable]):
+        """
+        Await `fetch()`, sharing one run among concurrent callers with the
+        same key. The run is not cancelled when a caller goes away.
+        """
+        if (task := self.inflight.get(key)) is None:
+            task = asyncio.create_task(fetch(), name=f"singleflight-{key[:8]}")
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            logger.info(f"coalescing request {key[:8]}")
+        return await asyncio.shield(task)
@@ -0,0 +1,1000 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+from collections.abc import Callable, Iterable, Sequence
+from logging import getLogger
+from typing import Any, Self
+import numpy as np
+import orjson
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_core.vectorstores.utils import maximal_marginal_relevance
+
+logger = getLogger(__name__)
+
+MODES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def quantize(vectors: np.ndarray, mode: str) -> tuple[np.ndarray, np.ndarray]:
+    """Codes and per-vector scales for the float32 rows of `vectors`."""
+    if mode != "int8":
+        return vectors.astype(MODES[mode]), np.ones(len(vectors), np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+# rows converted to float32 at a time; small enough to stay in cache
+CHUNK = 512
+
+
+def scan(codes: np.ndarray, scales: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    """
+    Similarities of each unit row of `queries` to every row of `codes` times
+    `scales`, one column per query.
+    """
+    scores = np.empty((len(codes), len(queries)), dtype=np.float32)
+    for start in range(0, len(codes), CHUNK):
+        stop = min(start + CHUNK, len(codes))
+        chunk = codes[start:stop].astype(np.float32, copy=False)
+        scores[start:stop] = chunk @ queries.T
+    scores *= scales[: len(codes), None]
+    return scores
+
+
+def top(scores: np.ndarray, n: int) -> np.ndarray:
+    """Row indices of the `n` largest scores of each column, in no order."""
+    n = min(n, len(scores))
+    if n == 0:
+        return np.empty((0, scores.shape[1]), np.intp)
+    return np.argpartition(-scores, n - 1, axis=0)[:n]
+
+
+# filter operators, as in Chroma's `where`
+OPERATORS = {
+    "$eq": "=",
+    "$gt": ">",
+    "$gte": ">=",
+    "$lt": "<",
+    "$lte": "<=",
+    "$in": "IN",
+}
+
+
+def _where(filter: dict) -> tuple[str, list]:
+    """A query for the ids of the documents whose tags match `filter`."""
+    parts = []
+    for key, cond in filter.items():
+        if key in ("$and", "$or"):
+            subs = [_where(f) for f in cond]
+            joiner = " INTERSECT " if key == "$and" else " UNION "
+            sql = joiner.join(f"SELECT id FROM ({sql})" for sql, _ in subs)
+            parts.append((sql, [p for _, params in subs for p in params]))
+            continue
+        for op, value in (cond if isinstance(cond, dict) else {"$eq": cond}).items():
+            if op not in OPERATORS:
+                raise ValueError(f"unsupported filter operator {op!r}")
+            if op == "$in":
+                marks = f"({','.join('?' * len(value))})"
+                parts.append(
+                    (
+                        f"SELECT id FROM tags WHERE key = ? AND value IN {marks}",
+                        [key, *value],
+                    )
+                )
+            else:
+                parts.append(
+                    (
+                        f"SELECT id FROM tags WHERE key = ? AND value {OPERATORS[op]} ?",
+                        [key, value],
+                    )
+                )
+    if not parts:
+        return "SELECT id FROM docs", []
+    sql = " INTERSECT ".join(f"SELECT id FROM ({sql})" for sql, _ in parts)
+    return sql, [p for _, params in parts for p in params]
+
+
+class ScanVectorStore(VectorStore):
+    """
+    Common LangChain API of the brute-force cosine stores. Subclasses keep
+    documents in an SQLite `docs` table, store the vectors and implement
+    `_add`, `delete`, `get_by_ids` and `_search_many`.
+
+    Scalar metadata values are indexed in a `tags` table, so searches with a
+    Chroma-style `filter` scan only the rows of the matching documents.
+    """
+
+    embedding_function: Embeddings
+    mode: str
+    db: sqlite3.Connection
+    lock: threading.Lock
+    rows: dict[str, int]
+
+    def _create_tags(self):
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tags (key TEXT NOT NULL, value, id TEXT NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS tags_key ON tags (key, value)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tags_id ON tags (id)")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < 1:
+            # stores written before tags existed
+            self.db.execute("BEGIN")
+            docs = self.db.execute("SELECT id, metadata FROM docs").fetchall()
+            self._tag([id for id, _ in docs], [orjson.loads(m) for _, m in docs])
+            self.db.execute("PRAGMA user_version = 1")
+            self.db.execute("COMMIT")
+
+    def _tag(self, ids: list[str], metadatas: list[dict]):
+        """Index the metadata of `ids`; call inside the write transaction."""
+        self._untag(ids)
+        self.db.executemany(
+            "INSERT INTO tags VALUES (?, ?, ?)",
+            [
+                (key, value, id)
+                for id, meta in zip(ids, metadatas)
+                for key, value in (meta or {}).items()
+                if isinstance(value, (str, int, float, bool))
+            ],
+        )
+
+    def _untag(self, ids: list[str]):
+        self.db.executemany("DELETE FROM tags WHERE id = ?", [(id,) for id in ids])
+
+    def _subset(self, filter: dict | None) -> np.ndarray | None:
+        """Sorted rows of the documents matching `filter`, or None for all."""
+        if filter is None:
+            return None
+        sql, params = _where(filter)
+        ids = self.db.execute(sql, params).fetchall()
+        return np.array(
+            sorted(self.rows[id] for id, in ids if id in self.rows), dtype=np.intp
+        )
+
+    def _add(
+        self,
+        texts: list[str],
+        vectors: Sequence[Sequence[float]],
+        metadatas: list[dict] | None,
+        ids: list[str] | None,
+    ) -> list[str]:
+        raise NotImplementedError
+
+    def _search_many(
+        self,
+        embeddings: Sequence[Sequence[float]],
+        n: int,
+        filter: dict | None = None,
+    ) -> list[tuple[list[str], np.ndarray, np.ndarray]]:
+        """
+        For each embedding, the ids, similarities and vectors of its `n` best
+        matches among the documents matching `filter`, best first.
+        """
+        raise NotImplementedError
+
+    def _search(self, embedding: Sequence[float], n: int, filter: dict | None = None):
+        return self._search_many([embedding], n, filter)[0]
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        *,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        vectors = self.embedding_function.embed_documents(texts)
+        return self._add(texts, vectors, metadatas, ids)
+
+    async def aadd_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        *,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        vectors = await self.embedding_function.aembed_documents(texts)
+        return await asyncio.to_thread(self._add, texts, vectors, metadatas, ids)
+
+    def add_embeddings(
+        self,
+        texts: list[str],
+        vectors: Sequence[Sequence[float]],
+        metadatas: list[dict] | None = None,
+        ids: list[str] | None = None,
+    ) -> list[str]:
+        return self._add(texts, vectors, metadatas, ids)
+
+    async def adelete(self, ids: list[str] | None = None, **kwargs: Any) -> bool | None:
+        return await asyncio.to_thread(self.delete, ids)
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self.embedding_function.embed_query(query), k, filter
+        )
+
+    async def asimilarity_search_with_score(
+        self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        embedding = await self.embedding_function.aembed_query(query)
+        return await asyncio.to_thread(
+            self.similarity_search_by_vector_with_score, embedding, k, filter
+        )
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4, filter: dict | None = None
+    ) -> list[tuple[Document, float]]:
+        """Documents with their cosine distance to `embedding`."""
+        ids, scores, _ = self._search(embedding, k, filter)
+        docs = {doc.id: doc for doc in self.get_by_ids(ids)}
+        return [(docs[id], 1 - float(s)) for id, s in zip(ids, scores) if id in docs]
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    async def asimilarity_search(
+        self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any
+    ) -> list[Document]:
+        return [
+            doc for doc, _ in await self.asimilarity_search_with_score(query, k, filter)
+        ]
+
+    def similarity_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_by_vector_with_score(
+                embedding, k, filter
+            )
+        ]
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vectors(
+            [embedding], k, fetch_k, lambda_mult, filter
+        )[0]
+
+    def max_marginal_relevance_search_by_vectors(
+        self,
+        embeddings: Sequence[Sequence[float]],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict | None = None,
+    ) -> list[list[Document]]:
+        """MMR search for each of `embeddings`, scanning the store once for all."""
+        picked = []
+        for query, (ids, _, vectors) in zip(
+            normalize(embeddings), self._search_many(embeddings, fetch_k, filter)
+        ):
+            chosen = maximal_marginal_relevance(
+                query, list(vectors), lambda_mult=lambda_mult, k=k
+            )
+            picked.append([ids[i] for i in chosen] if ids else [])
+        docs = {d.id: d for d in self.get_by_ids(list({i for p in picked for i in p}))}
+        return [[docs[id] for id in ids if id in docs] for ids in picked]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self.embedding_function.embed_query(query), k, fetch_k, lambda_mult, filter
+        )
+
+    async def amax_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        embedding = await self.embedding_function.aembed_query(query)
+        return await asyncio.to_thread(
+            self.max_marginal_relevance_search_by_vector,
+            embedding,
+            k,
+            fetch_k,
+            lambda_mult,
+            filter,
+        )
+
+    def metadatas(self) -> dict[str, dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT id, metadata FROM docs").fetchall()
+        return {id: orjson.loads(meta) for id, meta in rows}
+
+    def update_metadata(self, ids: list[str], metadatas: list[dict]):
+        """Replace the metadata of `ids`, keeping their texts and vectors."""
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "UPDATE docs SET metadata = ? WHERE id = ?",
+                    [(orjson.dumps(m or {}), id) for id, m in zip(ids, metadatas)],
+                )
+                self._tag(ids, metadatas)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def import_from(self, store: VectorStore, batch: int = 1000) -> int:
+        """Copy every document and vector out of a Chroma store."""
+        total = 0
+        while True:
+            got = store.get(  # type: ignore
+                include=["documents", "metadatas", "embeddings"],
+                limit=batch,
+                offset=total,
+            )
+            if not got["ids"]:
+                break
+            self._add(
+                got["documents"],
+                got["embeddings"],
+                [m or {} for m in got["metadatas"]],
+                got["ids"],
+            )
+            total += len(got["ids"])
+        logger.info(f"imported {total} vectors into {self.mode} store")
+        return total
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        *,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> Self:
+        store = cls(kwargs.pop("collection_name", "langchain"), embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+
+def backfill_metadata(store: VectorStore, fill: Callable[[dict], dict | None]) -> int:
+    """
+    Replace the metadata of each document for which `fill` returns new
+    metadata, without re-embedding; returns how many were changed.
+    """
+    if isinstance(store, ScanVectorStore):
+        current = store.metadatas()
+    else:
+        got = store.get(include=["metadatas"])  # type: ignore
+        current = {id: m or {} for id, m in zip(got["ids"], got["metadatas"])}
+    changed = {id: new for id, m in current.items() if (new := fill(m)) is not None}
+    if changed:
+        ids = list(changed)
+        metadatas = list(changed.values())
+        if isinstance(store, ScanVectorStore):
+            store.update_metadata(ids, metadatas)
+        else:
+            store._collection.update(ids=ids, metadatas=metadatas)  # type: ignore
+    return len(changed)
+
+
+def _chroma_mmr_many(
+    store,
+    embeddings: list[list[float]],
+    k: int,
+    fetch_k: int,
+    lambda_mult: float,
+    filter: dict | None,
+) -> list[list[Document]]:
+    got = store._collection.query(
+        query_embeddings=embeddings,
+        n_results=fetch_k,
+        where=filter,
+        include=["documents", "metadatas", "embeddings"],
+    )
+    results = []
+    for i, embedding in enumerate(embeddings):
+        if not len(got["ids"][i]):
+            results.append([])
+            continue
+        picked = maximal_marginal_relevance(
+            np.array(embedding, dtype=np.float32),
+            got["embeddings"][i],
+            lambda_mult=lambda_mult,
+            k=k,
+        )
+        results.append(
+            [
+                Document(
+                    page_content=got["documents"][i][j],
+                    metadata=got["metadatas"][i][j] or {},
+                    id=got["ids"][i][j],
+                )
+                # in rank order, as langchain_chroma returns them
+                for j in sorted(picked)
+            ]
+        )
+    return results
+
+
+async def amax_marginal_relevance_search_many(
+    store: VectorStore,
+    queries: list[str],
+    k: int = 4,
+    fetch_k: int = 20,
+    lambda_mult: float = 0.5,
+    filter: dict | None = None,
+    embeddings: Sequence[Sequence[float]] | None = None,
+) -> list[list[Document]]:
+    """
+    MMR search for each of `queries` among the documents matching `filter`,
+    embedding them in one request unless their `embeddings` are given and,
+    for the brute-force stores and Chroma, searching them all in one pass.
+    """
+    if not queries:
+        return []
+    if embeddings is None:
+        assert store.embeddings is not None
+        embeddings = await store.embeddings.aembed_documents(queries)
+    if isinstance(store, ScanVectorStore):
+        search = store.max_marginal_relevance_search_by_vectors
+        return await asyncio.to_thread(
+            search, embeddings, k, fetch_k, lambda_mult, filter
+        )
+    if getattr(store, "_collection", None) is not None:
+        return await asyncio.to_thread(
+            _chroma_mmr_many, store, embeddings, k, fetch_k, lambda_mult, filter
+        )
+    return list(
+        await asyncio.gather(
+            *(
+                store.amax_marginal_relevance_search_by_vector(
+                    e, k, fetch_k, lambda_mult, filter=filter
+                )
+                for e in embeddings
+            )
+        )
+    )
+
+
+class QuantizedVectorStore(ScanVectorStore):
+    """
+    Brute-force cosine vector store keeping unit vectors as float16 or
+    per-vector scaled int8 codes, with texts and metadata in SQLite.
+
+    Searches scan the codes in memory. In int8 mode the best `RERANK` times
+    `k` candidates are then re-scored exactly against float16 copies of their
+    vectors, which stay on disk and are read only for those candidates.
+    """
+
+    RERANK = 4
+
+    def __init__(
+        self,
+        collection_name: str,
+        embedding_function: Embeddings,
+        persist_directory: str | None = None,
+        mode: str = "int8",
+    ) -> None:
+        if mode not in ("float16", "int8"):
+            raise ValueError(f"unknown vector mode {mode!r}, expected float16 or int8")
+        self.mode = mode
+        self.embedding_function = embedding_function
+        path = ":memory:"
+        if persist_directory:
+            os.makedirs(persist_directory, exist_ok=True)
+            path = os.path.join(persist_directory, f"{collection_name}.{mode}.sqlite3")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # 1024-dim rows are just over half of a default 4K page; larger pages
+        # pack them without leaving half of every page empty
+        self.db.execute("PRAGMA page_size=16384")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, text TEXT NOT NULL,"
+            " metadata BLOB, code BLOB NOT NULL, scale REAL NOT NULL, exact BLOB)"
+        )
+        self._create_tags()
+        self._load()
+
+    def close(self):
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def _load(self):
+        rows = self.db.execute("SELECT id, code, scale FROM docs").fetchall()
+        self.ids: list[str] = [row[0] for row in rows]
+        self.rows = {id: i for i, id in enumerate(self.ids)}
+        codes = np.frombuffer(b"".join(row[1] for row in rows), MODES[self.mode])
+        # row buffers grow by doubling; only the first len(self.ids) rows are live
+        self.codes = codes.reshape(len(rows), -1).copy() if rows else codes[:, None]
+        self.scales = np.array([row[2] for row in rows], dtype=np.float32)
+        logger.info(f"loaded {len(rows)} {self.mode} vectors")
+
+    def _add(
+        self,
+        texts: list[str],
+        vectors: Sequence[Sequence[float]],
+        metadatas: list[dict] | None,
+        ids: list[str] | None,
+    ) -> list[str]:
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        unit = normalize(vectors)
+        codes, scales = quantize(unit, self.mode)
+        exact = unit.astype(np.float16) if self.mode == "int8" else None
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            id,
+                            text,
+                            orjson.dumps(meta or {}),
+                            codes[i].tobytes(),
+                            float(scales[i]),
+                            exact[i].tobytes() if exact is not None else None,
+                        )
+                        for i, (id, text, meta) in enumerate(zip(ids, texts, metadatas))
+                    ],
+                )
+                self._tag(ids, metadatas)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self._index(ids, codes, scales)
+        return ids
+
+    def _index(self, ids: list[str], codes: np.ndarray, scales: np.ndarray):
+        fresh = []
+        for i, id in enumerate(ids):
+            if (row := self.rows.get(id)) is not None:
+                self.codes[row] = codes[i]
+                self.scales[row] = scales[i]
+            else:
+                self.rows[id] = len(self.ids) + len(fresh)
+                fresh.append(i)
+        if not fresh:
+            return
+        size = len(self.ids)
+        if self.codes.size == 0:
+            self.codes = np.empty((0, codes.shape[1]), codes.dtype)
+        if size + len(fresh) > len(self.codes):
+            capacity = max(size + len(fresh), 2 * len(self.codes), 64)
+            self.codes = np.resize(self.codes, (capacity, codes.shape[1]))
+            self.scales = np.resize(self.scales, capacity)
+        self.codes[size : size + len(fresh)] = codes[fresh]
+        self.scales[size : size + len(fresh)] = scales[fresh]
+        self.ids += [ids[i] for i in fresh]
+
+    def _unindex(self, ids: list[str]):
+        for id in ids:
+            if (row := self.rows.pop(id, None)) is None:
+                continue
+            last = len(self.ids) - 1
+            if row != last:
+                moved = self.ids[last]
+                self.ids[row] = moved
+                self.rows[moved] = row
+                self.codes[row] = self.codes[last]
+                self.scales[row] = self.scales[last]
+            self.ids.pop()
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> bool | None:
+        if not ids:
+            return None
+        with self.lock:
+            self.db.executemany("DELETE FROM docs WHERE id = ?", [(id,) for id in ids])
+            self._untag(ids)
+            self._unindex(ids)
+        return True
+
+    def _fetch(self, ids: list[str], columns: str) -> dict[str, tuple]:
+        found = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            rows = self.db.execute(
+                f"SELECT id, {columns} FROM docs WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            found.update((row[0], row[1:]) for row in rows)
+        return found
+
+    def get_by_ids(self, ids: Sequence[str], /) -> list[Document]:
+        with self.lock:
+            found = self._fetch(list(ids), "text, metadata")
+        return [
+            Document(
+                page_content=found[id][0], metadata=orjson.loads(found[id][1]), id=id
+            )
+            for id in ids
+            if id in found
+        ]
+
+    def _search_many(
+        self,
+        embeddings: Sequence[Sequence[float]],
+        n: int,
+        filter: dict | None = None,
+    ):
+        queries = normalize(embeddings)
+        rerank = self.mode == "int8"
+        with self.lock:
+            subset = self._subset(filter)
+            if not self.ids or (subset is not None and not len(subset)):
+                return [([], np.empty(0), np.empty((0, queries.shape[1])))] * len(
+                    queries
+                )
+            if subset is None:
+                scores = scan(self.codes[: len(self.ids)], self.scales, queries)
+            else:
+                scores = scan(self.codes[subset], self.scales[subset], queries)
+            local = top(scores, n * self.RERANK if rerank else n)
+            rows = local if subset is None else subset[local]
+            ids = {r: self.ids[r] for r in np.unique(rows)}
+            if rerank:
+                exact = self._fetch(list(ids.values()), "exact")
+                vectors = {
+                    r: np.frombuffer(exact[id][0], dtype=np.float16).astype(np.float32)
+                    for r, id in ids.items()
+                }
+            else:
+                vectors = {r: self.codes[r].astype(np.float32) for r in ids}
+        results = []
+        for col, query in enumerate(queries):
+            found = rows[:, col]
+            matrix = np.stack([vectors[r] for r in found])
+            sims = matrix @ query if rerank else scores[local[:, col], col]
+            order = np.argsort(-sims)[:n]
+            results.append(([ids[found[i]] for i in order], sims[order], matrix[order]))
+        return results
+
+
+class MmapVectorStore(ScanVectorStore):
+    """
+    Unit vectors as rows of a memory-mapped file (float32, float16 or int8
+    codes, with per-row scales in a second file), and ids, texts and metadata
+    in a SQLite sidecar that maps each id to its row. Opening maps the files
+    without reading them.
+
+    Writes only append rows. Replaced and deleted rows stay in the files as
+    dead rows until they outnumber `COMPACT_RATIO` of all rows, when the live
+    rows are copied into files of the next generation.
+    """
+
+    COMPACT_RATIO = 0.25
+    COMPACT_MIN = 1024
+
+    def __init__(
+        self,
+        collection_name: str,
+        embedding_function: Embeddings,
+        persist_directory: str | None = None,
+        mode: str = "float32",
+    ) -> None:
+        if mode not in MODES:
+            raise ValueError(
+                f"unknown vector mode {mode!r}, expected one of {list(MODES)}"
+            )
+        self.mode = mode
+        self.dtype = np.dtype(MODES[mode])
+        self.embedding_function = embedding_function
+        # an unpersisted store lives in a directory removed with the store
+        self.tmp: tempfile.TemporaryDirectory | None = None
+        if persist_directory:
+            directory = persist_directory
+        else:
+            self.tmp = tempfile.TemporaryDirectory(prefix="vectors-")
+            directory = self.tmp.name
+        os.makedirs(directory, exist_ok=True)
+        self.prefix = os.path.join(directory, f"{collection_name}.mmap-{mode}")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.prefix + ".sqlite3", check_same_thread=False, isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY,"
+            " row INTEGER NOT NULL, text TEXT NOT NULL, metadata BLOB)"
+        )
+        self._create_tags()
+        meta = dict(self.db.execute("SELECT key, value FROM meta").fetchall())
+        self.generation = meta.get("generation", 0)
+        self.dimensions: int | None = meta.get("dimensions")
+        self._remove_stale()
+        self._map()
+        self.ids: list[str | None] = [None] * len(self.codes)
+        self.rows: dict[str, int] = {}
+        for id, row in self.db.execute("SELECT id, row FROM docs"):
+            if row < len(self.ids):
+                self.ids[row] = id
+                self.rows[id] = row
+        self.alive = np.array([id is not None for id in self.ids], dtype=bool)
+        logger.info(
+            f"mapped {len(self.rows)} {mode} vectors, {len(self.ids) - len(self.rows)} dead"
+        )
+
+    def _files(self, generation: int) -> tuple[str, str]:
+        return (
+            f"{self.prefix}.{generation}.vectors",
+            f"{self.prefix}.{generation}.scales",
+        )
+
+    def _remove_stale(self):
+        # leftovers of a compaction that crashed or finished before cleanup
+        current = self._files(self.generation)
+        directory, name = os.path.split(self.prefix)
+        for file in os.listdir(directory):
+            path = os.path.join(directory, file)
+            if file.startswith(name + ".") and file.endswith((".vectors", ".scales")):
+                if path not in current:
+                    os.remove(path)
+
+    def _map(self):
+        vectors, scales = self._files(self.generation)
+        for path in (vectors, scales):
+            open(path, "ab").close()
+        width = (self.dimensions or 0) * self.dtype.itemsize
+        size = min(
+            os.path.getsize(vectors) // width if width else 0,
+            os.path.getsize(scales) // 4,
+        )
+        if size == 0:
+            self.codes = np.empty((0, self.dimensions or 0), self.dtype)
+            self.scales = np.empty(0, np.float32)
+            return
+        self.codes = np.memmap(
+            vectors, self.dtype, "r", shape=(size, self.dimensions or 0)
+        )
+        self.scales = np.memmap(scales, np.float32, "r", shape=(size,))
+
+    def close(self):
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+            self.codes = self.scales = np.empty(0)
+            if self.tmp is not None:
+                self.tmp.cleanup()
+
+    @property
+    def count(self) -> int:
+        return len(self.rows)
+
+    def _append(self, codes: np.ndarray, scales: np.ndarray) -> int:
+        """Append rows after the last complete row, returning the first's index."""
+        start = len(self.ids)
+        vectors, scale_file = self._files(self.generation)
+        for path, data, width in (
+            (vectors, codes, codes.shape[1] * self.dtype.itemsize),
+            (scale_file, scales, 4),
+        ):
+            with open(path, "r+b") as f:
+                # a crash can leave a partial or unreferenced row at the end
+                f.truncate(start * width)
+                f.seek(start * width)
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        return start
+
+    def _kill(self, row: int):
+        self.ids[row] = None
+        self.alive[row] = False
+
+    def _add(
+        self,
+        texts: list[str],
+        vectors: Sequence[Sequence[float]],
+        metadatas: list[dict] | None,
+        ids: list[str] | None,
+    ) -> list[str]:
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        codes, scales = quantize(normalize(vectors), self.mode)
+        with self.lock:
+            if self.dimensions is None:
+                self.dimensions = codes.shape[1]
+                self.db.execute(
+                    "INSERT INTO meta VALUES ('dimensions', ?)", (self.dimensions,)
+                )
+            elif codes.shape[1] != self.dimensions:
+                raise ValueError(
+                    f"got {codes.shape[1]}-dim vectors for a {self.dimensions}-dim store"
+                )
+            start = self._append(codes, scales)
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT INTO docs VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE"
+                    " SET row = excluded.row, text = excluded.text,"
+                    " metadata = excluded.metadata",
+                    [
+                        (id, start + i, text, orjson.dumps(meta or {}))
+                        for i, (id, text, meta) in enumerate(zip(ids, texts, metadatas))
+                    ],
+                )
+                self._tag(ids, metadatas)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.ids += ids
+            self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+            for i, id in enumerate(ids):
+                if (row := self.rows.get(id)) is not None:
+                    self._kill(row)
+                self.rows[id] = start + i
+            self._map()
+            self._maybe_compact()
+        return ids
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> bool | None:
+        if not ids:
+            return None
+        with self.lock:
+            self.db.executemany("DELETE FROM docs WHERE id = ?", [(id,) for id in ids])
+            self._untag(ids)
+            for id in ids:
+                if (row := self.rows.pop(id, None)) is not None:
+                    self._kill(row)
+            self._maybe_compact()
+        return True
+
+    def _maybe_compact(self):
+        dead = len(self.ids) - len(self.rows)
+        if dead >= self.COMPACT_MIN and dead >= self.COMPACT_RATIO * len(self.ids):
+            self._compact()
+
+    def _compact(self):
+        live = np.flatnonzero(self.alive)
+        generation = self.generation + 1
+        vectors, scales = self._files(generation)
+        with open(vectors, "wb") as fv, open(scales, "wb") as fs:
+            for start in range(0, len(live), 65536):
+                rows = live[start : start + 65536]
+                fv.write(np.ascontiguousarray(self.codes[rows]).tobytes())
+                fs.write(np.ascontiguousarray(self.scales[rows]).tobytes())
+            for f in (fv, fs):
+                f.flush()
+                os.fsync(f.fileno())
+        ids = [self.ids[row] for row in live]
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany(
+                "UPDATE docs SET row = ? WHERE id = ?",
+                [(row, id) for row, id in enumerate(ids)],
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation,)
+            )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            os.remove(vectors)
+            os.remove(scales)
+            raise
+        dead = len(self.ids) - len(ids)
+        self.generation = generation
+        self._remove_stale()
+        self.ids = ids  # type: ignore
+        self.rows = {id: row for row, id in enumerate(ids)}  # type: ignore
+        self.alive = np.ones(len(ids), dtype=bool)
+        self._map()
+        logger.info(f"compacted {dead} dead rows, {len(ids)} vectors left")
+
+    def get_by_ids(self, ids: Sequence[str], /) -> list[Document]:
+        found = {}
+        ids = list(ids)
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i : i + 500]
+                found.update(
+                    (row[0], row[1:])
+                    for row in self.db.execute(
+                        "SELECT id, text, metadata FROM docs WHERE id IN"
+                        f" ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+        return [
+            Document(
+                page_content=found[id][0], metadata=orjson.loads(found[id][1]), id=id
+            )
+            for id in ids
+            if id in found
+        ]
+
+    def _search_many(
+        self,
+        embeddings: Sequence[Sequence[float]],
+        n: int,
+        filter: dict | None = None,
+    ):
+        queries = normalize(embeddings)
+        with self.lock:
+            subset = self._subset(filter)
+            if not self.rows or (subset is not None and not len(subset)):
+                return [([], np.empty(0), np.empty((0, queries.shape[1])))] * len(
+                    queries
+                )
+            if subset is None:
+                scores = scan(self.codes, self.scales, queries)
+                scores[~self.alive] = -np.inf
+                local = top(scores, min(n, len(self.rows)))
+                rows = local
+            else:
+                # subset rows are all alive
+                scores = scan(self.codes[subset], self.scales[subset], queries)
+                local = top(scores, n)
+                rows = subset[local]
+            unique = np.unique(rows)
+            ids = {r: self.ids[r] for r in unique}
+            matrix = self.codes[unique].astype(np.float32) * self.scales[unique, None]
+            vectors = dict(zip(unique, matrix))
+        results = []
+        for col in range(len(queries)):
+            sims = scores[local[:, col], col]
+            order = np.argsort(-sims)
+            found = rows[order, col]
+            results.append(
+                (
+                    [ids[r] for r in found],
+                    sims[order],
+                    np.stack([vectors[r] for r in found]),
+                )
+            )
+        return results